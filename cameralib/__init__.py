@@ -57,3 +57,4 @@ API
 
 name = "cameralib"
 from .projector import Projector
+from .registry import ProjectorPool
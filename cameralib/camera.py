@@ -13,6 +13,66 @@ def map_pixels(from_camera, to_camera, pixels):
     return to_camera.project_many(from_camera.pixel_bearing_many(pixels))
 
 
+def shots_to_arrays(shots):
+    """Stack the pose and image size of shots into arrays for vectorized projection"""
+    return {
+        'translation': np.array([s['translation'] for s in shots], dtype=np.float64).reshape((-1, 3)),
+        'rotation': np.array([s['rotation'] for s in shots], dtype=np.float64).reshape((-1, 3, 3)),
+        'f': np.array([s['focal'] * max(s['width'], s['height']) for s in shots], dtype=np.float64),
+        'width': np.array([s['width'] for s in shots], dtype=np.float64),
+        'height': np.array([s['height'] for s in shots], dtype=np.float64),
+    }
+
+
+def project_to_shots(shot_arrays, points):
+    """Pinhole projection of world points into all shots at once
+
+    Args:
+        shot_arrays (dict): output of shots_to_arrays
+        points (numpy.ndarray): (N, 3) array of world coordinates
+
+    Returns:
+        tuple: x, y, inside where x, y are (S, N) arrays of pinhole image coordinates
+        and inside is True for points in front of the camera that fall within the image
+    """
+    d = points[None, :, :] - shot_arrays['translation'][:, None, :]
+    c = np.einsum('sij,snj->sni', shot_arrays['rotation'], d)
+    f = shot_arrays['f'][:, None]
+    img_w = shot_arrays['width'][:, None]
+    img_h = shot_arrays['height'][:, None]
+
+    den = c[:, :, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (img_w - 1) / 2.0 - f * c[:, :, 0] / den
+        y = (img_h - 1) / 2.0 - f * c[:, :, 1] / den
+
+    inside = (den > 0) & (x >= 0) & (y >= 0) & (x <= img_w - 1) & (y <= img_h - 1)
+    return x, y, inside
+
+
+def distort_pixels(camera, x, y, img_w, img_h, round_pixels=True):
+    """Convert pinhole image coordinates from project_to_shots to pixel coordinates in the (distorted) image
+
+    Args:
+        camera (Camera): camera model of the shot(s)
+        img_w (float or numpy.ndarray): image width of the shot(s)
+        img_h (float or numpy.ndarray): image height of the shot(s)
+        round_pixels (bool): Round pinhole coordinates to whole pixels before applying distortion, as world2cams does
+
+    Returns:
+        tuple: x, y, valid where valid is True for coordinates that fall within the image
+    """
+    if round_pixels:
+        x = np.round(x)
+        y = np.round(y)
+
+    xi = img_w - 1 - x
+    yi = img_h - 1 - y
+    xu, yu = map_pixels(camera.undistorted(), camera, np.column_stack((xi, yi))).T
+    valid = (xu >= 0) & (xu <= img_w) & (yu >= 0) & (yu <= img_h)
+    return xu, yu, valid
+
+
 def rodrigues_vec_to_rotation_mat(rodrigues_vec):
     theta = np.linalg.norm(rodrigues_vec)
     if theta < sys.float_info.epsilon:
@@ -99,69 +159,87 @@ class BrownCamera(Camera):
         self.distortion = np.array([self.k1, self.k2, self.p1, self.p2, self.k3])
 
 
-def load_shots(shots_path):
-    """Load camera shots"""
+def read_shots_properties(shots_path):
+    """Read the properties of each feature in a shots.geojson file"""
     with open(shots_path) as f:
         shots = json.loads(f.read())
     
     if not "features" in shots:
         raise IOError("Invalid shots.geojson file.")
 
+    return [feat.get("properties") for feat in shots["features"]]
+
+def parse_shot(props):
+    """Parse the properties of a shots.geojson feature
+
+    Returns:
+        dict: the shot, or None if the properties do not describe a valid shot
+    """
+    if props is None:
+        return None
+
+    focal = props.get('focal', props.get('focal_x'))
+    if focal is None:
+        return None
+
+    width = props.get('width')
+    height = props.get('height')
+    if not width or not height:
+        return None
+
+    return {
+        'cam_id': props.get('camera'),
+        'filename': props.get('filename'),
+        'focal': focal,
+        'translation': np.array(props['translation']),
+        'rotation': rodrigues_vec_to_rotation_mat(np.array(props['rotation'])),
+        'width': width,
+        'height': height
+    }
+
+def load_shots(shots_path):
+    """Load camera shots"""
     result = []
     idx = 0
     shots_map = {}
-    for feat in shots["features"]:
-        props = feat.get("properties")
-        if props is None:
+    for props in read_shots_properties(shots_path):
+        shot = parse_shot(props)
+        if shot is None:
             continue
 
-        focal = props.get('focal', props.get('focal_x'))
-        if focal is None:
-            continue
-
-        cam_id = props.get('camera')
-        filename = props.get('filename')
-        translation = np.array(props['translation'])
-        rotation = rodrigues_vec_to_rotation_mat(np.array(props['rotation']))
-        width = props.get('width')
-        height = props.get('height')
-        if not width or not height:
-            continue
-
-        result.append({
-            'cam_id': cam_id,
-            'filename': filename,
-            'focal': focal,
-            'translation': translation,
-            'rotation': rotation,
-            'width': width,
-            'height': height
-        })
-        shots_map[filename] = idx
+        result.append(shot)
+        shots_map[shot['filename']] = idx
         idx += 1
     
     return result, shots_map
 
-def load_cameras(cameras_file):
+def read_cameras(cameras_file):
     with open(cameras_file) as f:
-        cameras = json.load(f)
+        return json.load(f)
+
+def parse_camera(camera):
+    """Parse a camera definition from cameras.json
+
+    Returns:
+        Camera: the camera, or None if the projection type is not supported
+    """
+    if camera['projection_type'] == 'perspective':
+        return PerspectiveCamera(camera['width'], camera['height'], camera.get('focal', camera.get('focal_x')),
+                                camera['k1'], camera['k2'])
+    elif camera['projection_type'] == 'brown':
+        return BrownCamera(camera['width'], camera['height'], camera.get('focal', camera.get('focal_x')), 
+                            camera.get('c_x', 0), camera.get('c_y', 0),
+                            camera['k1'], camera['k2'], camera['p1'], camera['p2'], camera['k3'])
+    else:
+        logger.warning(f"{camera['projection_type']} camera type is not supported")
+        return None
+
+def load_cameras(cameras_file):
+    cameras = read_cameras(cameras_file)
 
     result = {}
     for cam_id in cameras:
-        camera = cameras[cam_id]
-
-        if camera['projection_type'] == 'perspective':
-            cam = PerspectiveCamera(camera['width'], camera['height'], camera.get('focal', camera.get('focal_x')),
-                                    camera['k1'], camera['k2'])
-        elif camera['projection_type'] == 'brown':
-            cam = BrownCamera(camera['width'], camera['height'], camera.get('focal', camera.get('focal_x')), 
-                                camera.get('c_x', 0), camera.get('c_y', 0),
-                                camera['k1'], camera['k2'], camera['p1'], camera['p2'], camera['k3'])
-        else:
-            logger.warning(f"{camera['projection_type']} camera type is not supported")
-            continue
-
-        result[cam_id] = cam
+        cam = parse_camera(cameras[cam_id])
+        if cam is not None:
+            result[cam_id] = cam
     return result
-
-
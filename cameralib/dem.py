@@ -0,0 +1,382 @@
+import os
+import glob
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
+import rasterio
+from scipy import ndimage
+from cameralib.exceptions import InvalidArgError, GeoError
+from cameralib.geo import raster_index_many, raster_sample_z_many, _get_sample_z
+
+
+logger = logging.getLogger(__name__)
+
+# Value used to mark nodata cells in quantized DEMs
+QUANTIZED_NODATA = {
+    'int16': np.iinfo(np.int16).min,
+    'uint16': np.iinfo(np.uint16).max,
+}
+
+class DEM:
+    """An elevation model held in memory for sampling
+
+    Args:
+        path (str): Path to a GeoTIFF DEM
+        fill_nodata (bool): Whether to fill nodata cells with nearest neighbor cell values
+        dtype (str): Storage type of the working DEM. One of: [None, 'float32', 'int16', 'uint16']. None keeps the type of the GeoTIFF.
+            Integer types store elevations as offset + value * z_scale, with nodata kept as a sentinel value.
+        z_scale (float): Precision of quantized elevations, in DEM units (0.01 is 1 cm precision for DEMs in meters)
+    """
+    def __init__(self, path, fill_nodata=True, dtype=None, z_scale=0.01):
+        if dtype is not None and dtype != 'float32' and dtype not in QUANTIZED_NODATA:
+            raise InvalidArgError(f"Invalid dem_dtype {dtype}")
+        if z_scale <= 0:
+            raise InvalidArgError("dem_z_scale must be > 0")
+
+        self.path = path
+        self.fill_nodata = fill_nodata
+        self.dtype = dtype
+        self.z_scale = z_scale
+
+        with rasterio.open(self.path, "r") as r:
+            self.nodata = r.nodata
+            self.width = r.width
+            self.height = r.height
+            self.raster_dtype = r.dtypes[0]
+            self.crs = r.crs
+            self.bounds = r.bounds
+            self.resolution = abs(r.transform[0])
+
+        self.raster = None
+        self.data = None
+        self.mtime = None
+        self.min_z = None
+        self.scale = None
+        self.offset = 0.0
+        self.on_load = None # called with the DEM after it's loaded
+        self._lock = threading.RLock()
+
+    @property
+    def quantized(self):
+        return self.dtype in QUANTIZED_NODATA
+
+    @property
+    def data_nodata(self):
+        """Value returned by sampling functions for nodata cells"""
+        if self.quantized:
+            return QUANTIZED_NODATA[self.dtype]
+        return self.nodata
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes if self.data is not None else 0
+
+    @property
+    def key(self):
+        """Identifies the source files of the DEM"""
+        return os.path.realpath(self.path)
+
+    @property
+    def estimated_nbytes(self):
+        """Size of the working DEM once loaded"""
+        return self.width * self.height * np.dtype(self.dtype or self.raster_dtype).itemsize
+
+    @property
+    def loaded(self):
+        return self.raster is not None
+
+    def load(self):
+        self.arrays()
+
+    def arrays(self):
+        """Raster and elevation array used for sampling, loaded again if the DEM was released.
+        Queries hold on to them so that a concurrent release does not affect them.
+
+        Returns:
+            tuple: raster, data
+        """
+        with self._lock:
+            loaded = self.raster is None
+            if loaded:
+                self._load()
+            arrays = (self.raster, self.data)
+
+        # Outside of the lock, the callback can release other DEMs
+        if loaded and self.on_load is not None:
+            self.on_load(self)
+        return arrays
+
+    def _load(self):
+        self.mtime = os.path.getmtime(self.path)
+        raster = rasterio.open(self.path, 'r')
+        if self.dtype == 'float32':
+            data = raster.read(1, out_dtype='float32')
+        else:
+            data = raster.read(1)
+
+        valid_mask = data != raster.nodata
+        self.min_z = data[valid_mask].min()
+
+        if self.quantized:
+            data = self._quantize(data, valid_mask)
+
+        if self.fill_nodata:
+            # Fill in place to avoid holding a second copy of the DEM
+            invalid_mask = ~valid_mask
+            indices = ndimage.distance_transform_edt(invalid_mask,
+                                                return_distances=False,
+                                                return_indices=True)
+            data[invalid_mask] = data[indices[0][invalid_mask], indices[1][invalid_mask]]
+            del indices
+
+        self.data = data
+        self.raster = raster
+
+    def _quantize(self, data, valid_mask):
+        info = np.iinfo(self.dtype)
+        sentinel = QUANTIZED_NODATA[self.dtype]
+        lo = info.min + 1 if sentinel == info.min else info.min
+        hi = info.max - 1 if sentinel == info.max else info.max
+
+        min_z = float(self.min_z)
+        max_z = float(data[valid_mask].max())
+        if (max_z - min_z) / self.z_scale > hi - lo:
+            raise InvalidArgError(f"Elevation range of {self.path} ({min_z} - {max_z}) does not fit in {self.dtype} with dem_z_scale {self.z_scale}")
+
+        self.scale = self.z_scale
+        self.offset = min_z - lo * self.scale
+
+        q = np.full(data.shape, sentinel, dtype=self.dtype)
+        q[valid_mask] = np.round((data[valid_mask].astype(np.float64) - self.offset) / self.scale)
+        return q
+
+    def changed(self):
+        """Whether the DEM file was modified since it was loaded"""
+        return self.mtime is not None and os.path.getmtime(self.path) != self.mtime
+
+    def sample(self, xs, ys, window=1, strategy='median', arrays=None):
+        """Sample elevation values at coordinates in the DEM's CRS
+
+        Args:
+            arrays (tuple): raster and data returned by :meth:`arrays`, to sample them without
+                reading the DEM's state again
+
+        Returns:
+            numpy.ndarray: elevation values, data_nodata for cells that are outside of the DEM or have no data
+        """
+        raster, data = arrays if arrays is not None else self.arrays()
+        rows, cols = raster_index_many(raster, xs, ys)
+        return raster_sample_z_many(data, self.data_nodata, rows, cols,
+                                    window=window, strategy=strategy,
+                                    scale=self.scale, offset=self.offset)
+
+    def close(self):
+        with self._lock:
+            if self.raster is not None:
+                self.raster.close()
+                self.raster = None
+            self.data = None
+            self.mtime = None
+
+
+class MosaicDEM:
+    """An elevation model made of multiple GeoTIFF tiles, such as the output of split-merge.
+    Tiles are read only when a sample falls within their bounds and are kept in a bounded pool.
+
+    Args:
+        paths (list of str): Paths to GeoTIFF tiles
+        fill_nodata (bool): Whether to fill nodata cells of each tile with nearest neighbor cell values
+        dtype (str): Storage type of the tiles. See :class:`DEM`
+        z_scale (float): Precision of quantized elevations. See :class:`DEM`
+        max_open_tiles (int): Maximum number of tiles kept in memory
+    """
+    def __init__(self, paths, fill_nodata=True, dtype=None, z_scale=0.01, max_open_tiles=16):
+        if len(paths) == 0:
+            raise InvalidArgError("No DEM tiles found")
+        if max_open_tiles <= 0:
+            raise InvalidArgError("max_open_tiles must be > 0")
+
+        self.path = list(paths)
+        self.fill_nodata = fill_nodata
+        self.dtype = dtype
+        self.z_scale = z_scale
+        self.max_open_tiles = max_open_tiles
+
+        self.tiles = [DEM(p, fill_nodata=fill_nodata, dtype=dtype, z_scale=z_scale) for p in self.path]
+        self.crs = self.tiles[0].crs
+        for t in self.tiles:
+            if t.crs != self.crs:
+                raise GeoError(f"{t.path} has a different CRS than {self.tiles[0].path}")
+
+        self.tile_bounds = np.array([t.bounds for t in self.tiles]) # left, bottom, right, top
+        self._tile_margins = np.array([t.resolution / 2.0 for t in self.tiles])
+        self.resolution = min(t.resolution for t in self.tiles)
+        self.mtime = max(os.path.getmtime(p) for p in self.path)
+        self.nodata = self.tiles[0].nodata
+        self.min_z = min(_tile_min(t.path) for t in self.tiles)
+        self.scale = None
+        self.offset = 0.0
+
+        self._open_tiles = OrderedDict() # tile index --> None, in LRU order
+        self.on_load = None # called with the mosaic after a tile is loaded
+        self._lock = threading.RLock()
+
+    @property
+    def data_nodata(self):
+        return self.tiles[0].data_nodata
+
+    @property
+    def key(self):
+        return tuple(os.path.realpath(p) for p in self.path)
+
+    @property
+    def nbytes(self):
+        return sum(t.nbytes for t in self.tiles)
+
+    @property
+    def estimated_nbytes(self):
+        sizes = sorted((t.estimated_nbytes for t in self.tiles), reverse=True)
+        return sum(sizes[:self.max_open_tiles])
+
+    @property
+    def loaded(self):
+        return len(self._open_tiles) > 0
+
+    @property
+    def raster(self):
+        return None
+
+    @property
+    def data(self):
+        return None
+
+    def load(self):
+        # Tiles are loaded on demand
+        pass
+
+    def arrays(self):
+        return None
+
+    def changed(self):
+        """Whether any tile was modified since the mosaic was opened or released"""
+        return any(os.path.getmtime(p) > self.mtime for p in self.path)
+
+    def _tile(self, i):
+        with self._lock:
+            loaded = i not in self._open_tiles
+            if loaded:
+                while len(self._open_tiles) >= self.max_open_tiles:
+                    j, _ = self._open_tiles.popitem(last=False)
+                    self.tiles[j].close()
+                arrays = self.tiles[i].arrays()
+                self._open_tiles[i] = None
+            else:
+                self._open_tiles.move_to_end(i)
+                arrays = self.tiles[i].arrays()
+
+        if loaded and self.on_load is not None:
+            self.on_load(self)
+        return self.tiles[i], arrays
+
+    def sample(self, xs, ys, window=1, strategy='median', arrays=None):
+        """Sample elevation values at coordinates in the DEM's CRS, reading only the tiles that contain them.
+        Where tiles overlap, the first tile with data is used.
+
+        Returns:
+            numpy.ndarray: elevation values, data_nodata for cells that are outside of the DEM or have no data
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        nodata = self.data_nodata
+        z = np.full(xs.shape, nodata, dtype=np.float64)
+        if len(xs) == 0:
+            return z
+
+        # Coordinates are rounded to the nearest cell, so points within half a cell of
+        # a tile edge can fall in the neighbouring tile: try both
+        b = self.tile_bounds
+        m = self._tile_margins
+        inside = (xs[:, None] >= b[:, 0] - m) & (xs[:, None] <= b[:, 2] + m) & \
+                 (ys[:, None] >= b[:, 1] - m) & (ys[:, None] <= b[:, 3] + m)
+
+        if window > 1:
+            within = (xs[:, None] >= b[:, 0]) & (xs[:, None] <= b[:, 2]) & \
+                     (ys[:, None] >= b[:, 1]) & (ys[:, None] <= b[:, 3])
+            return self._sample_window(xs, ys, within.any(axis=1), window, strategy)
+
+        for i in np.flatnonzero(inside.any(axis=0)):
+            todo = np.flatnonzero(inside[:, i] & (z == nodata))
+            if len(todo) == 0:
+                continue
+
+            tile, tile_arrays = self._tile(i)
+            tz = tile.sample(xs[todo], ys[todo], window, strategy, arrays=tile_arrays)
+            valid = tz != tile.data_nodata
+            z[todo[valid]] = tz[valid]
+
+        return z
+
+    def _sample_window(self, xs, ys, inside, window, strategy):
+        # Windows can cross tile edges: sample each cell of the windows separately
+        nodata = self.data_nodata
+        z = np.full(xs.shape, nodata, dtype=np.float64)
+        idx = np.flatnonzero(inside)
+
+        d = (np.arange(window) - window // 2) * self.resolution
+        dx = np.tile(d, window)
+        dy = -np.repeat(d, window)
+        cells = self.sample((xs[idx, None] + dx).ravel(), (ys[idx, None] + dy).ravel())
+        cells = cells.reshape((-1, window, window))
+
+        for k, i in enumerate(idx):
+            z[i] = _get_sample_z(cells[k], nodata, strategy)
+        return z
+
+    def close(self):
+        with self._lock:
+            for i in self._open_tiles:
+                self.tiles[i].close()
+            self._open_tiles.clear()
+            self.mtime = max(os.path.getmtime(p) for p in self.path)
+
+
+def _tile_min(path):
+    """Minimum valid value of a raster, from its exact statistics if available or by reading it block by block"""
+    with rasterio.open(path, 'r') as r:
+        tags = r.tags(1)
+        stats_min = tags.get('STATISTICS_MINIMUM')
+
+        # Approximate statistics come from overviews or a subset of the cells
+        # and can be above the lowest cell, which would stop rays too early
+        if stats_min is not None and tags.get('STATISTICS_APPROXIMATE', 'NO').upper() != 'YES':
+            return float(stats_min)
+
+        result = np.inf
+        for _, window in r.block_windows(1):
+            block = r.read(1, window=window)
+            block = block[block != r.nodata]
+            if block.size > 0:
+                result = min(result, float(block.min()))
+        return result
+
+def find_dem_tiles(path):
+    """List GeoTIFF tiles from a directory, a VRT or a list of paths"""
+    if isinstance(path, (list, tuple)):
+        return [os.path.abspath(p) for p in path]
+
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.tif")) + glob.glob(os.path.join(path, "*.tiff")))
+
+    with rasterio.open(path, 'r') as r:
+        files = [f if os.path.isabs(f) else os.path.join(os.path.dirname(path), f) for f in r.files]
+    return [os.path.abspath(f) for f in files if not f.lower().endswith((".vrt", ".ovr", ".aux.xml", ".msk"))]
+
+def is_mosaic(path):
+    return isinstance(path, (list, tuple)) or os.path.isdir(path) or path.lower().endswith(".vrt")
+
+def open_dem(path, fill_nodata=True, dtype=None, z_scale=0.01, max_open_tiles=16):
+    """Open a DEM from a GeoTIFF, or a mosaic from a directory of tiles, a VRT or a list of tile paths"""
+    if is_mosaic(path):
+        return MosaicDEM(find_dem_tiles(path), fill_nodata=fill_nodata, dtype=dtype, z_scale=z_scale, max_open_tiles=max_open_tiles)
+    return DEM(path, fill_nodata=fill_nodata, dtype=dtype, z_scale=z_scale)
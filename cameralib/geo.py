@@ -6,7 +6,12 @@ from cameralib.kernels import circle_kernel
 from rasterio.warp import transform
 from rasterio.crs import CRS
 
-def _get_sample_z(data, nodata, strategy):
+def _dequantize(z, scale, offset):
+    if scale is None:
+        return z
+    return z * scale + offset
+
+def _get_sample_z(data, nodata, strategy, scale=None, offset=0.0):
     window = data.shape[0]
 
     if window == 1:
@@ -28,9 +33,11 @@ def _get_sample_z(data, nodata, strategy):
         else:
             raise InvalidArgError("Invalid strategy: %s" % strategy)
     
-    return z
+    if z == nodata:
+        return z
+    return _dequantize(z, scale, offset)
 
-def raster_sample_z(rast_data, nodata, row, col, window=1, strategy='median'):
+def raster_sample_z(rast_data, nodata, row, col, window=1, strategy='median', scale=None, offset=0.0):
     half_win = window / 2.0
     h, w = rast_data.shape
     if row < 0 or col < 0 or row >= h or col >= w:
@@ -39,10 +46,33 @@ def raster_sample_z(rast_data, nodata, row, col, window=1, strategy='median'):
     try:
         data = rast_data[max(0, row-math.floor(half_win)):min(h, row+math.ceil(half_win)),
                          max(0, col-math.floor(half_win)):min(w, col+math.ceil(half_win))]
-        return _get_sample_z(data, nodata, strategy)
+        return _get_sample_z(data, nodata, strategy, scale, offset)
     except Exception as e:
         raise OutOfBoundsError("Cannot read Z value: %s" % str(e))
 
+def raster_sample_z_many(rast_data, nodata, rows, cols, window=1, strategy='median', scale=None, offset=0.0):
+    """Vectorized version of raster_sample_z for arrays of rows and columns"""
+    h, w = rast_data.shape
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    z = np.full(rows.shape, nodata, dtype=np.float64)
+    inside = (rows >= 0) & (cols >= 0) & (rows < h) & (cols < w)
+
+    if window == 1:
+        z[inside] = rast_data[rows[inside], cols[inside]]
+        valid = inside & (z != nodata)
+        z[valid] = _dequantize(z[valid], scale, offset)
+    else:
+        for i in np.flatnonzero(inside):
+            z[i] = raster_sample_z(rast_data, nodata, rows[i], cols[i], window, strategy, scale, offset)
+
+    return z
+
+def raster_index_many(raster, xs, ys):
+    """Vectorized equivalent of raster.index(x, y, op=round)"""
+    cols, rows = ~raster.transform * (np.asarray(xs), np.asarray(ys))
+    return np.round(rows).astype(np.int64), np.round(cols).astype(np.int64)
+
 def get_utm_xyz(raster, rast_data, nodata, latitude, longitude, z_sample_window=1, z_sample_strategy='median'):
     if raster.crs is None:
         raise GeoError(f"{raster_path} does not have a CRS")
@@ -64,4 +94,29 @@ def get_latlon(raster, easting, northing):
     dst = CRS({'init':'EPSG:4326'})
     longitude, latitude = transform(raster.crs, dst, [easting], [northing])
 
-    return latitude[0], longitude[0]
\ No newline at end of file
+    return latitude[0], longitude[0]
+
+def get_utm_xy(crs, latitude, longitude):
+    if crs is None:
+        raise GeoError("DEM does not have a CRS")
+
+    src_crs = CRS({'init':'EPSG:4326'})
+    x, y = transform(src_crs, crs, [longitude], [latitude])
+    return x[0], y[0]
+
+def get_utm_xy_many(crs, latitudes, longitudes):
+    if crs is None:
+        raise GeoError("DEM does not have a CRS")
+
+    src_crs = CRS({'init':'EPSG:4326'})
+    xs, ys = transform(src_crs, crs, list(longitudes), list(latitudes))
+    return np.array(xs), np.array(ys)
+
+def get_latlon_many(crs, eastings, northings):
+    if crs is None:
+        raise GeoError("DEM does not have a CRS")
+
+    dst = CRS({'init':'EPSG:4326'})
+    longitudes, latitudes = transform(crs, dst, list(eastings), list(northings))
+
+    return np.array(latitudes), np.array(longitudes)
@@ -0,0 +1,97 @@
+import os
+import numpy as np
+
+
+class LookupGrid:
+    """A coarse grid of raycast results for a single image, used to answer
+    pixel to ground queries by interpolation instead of ray marching.
+
+    Args:
+        xs (numpy.ndarray): x pixel coordinates of the grid columns
+        ys (numpy.ndarray): y pixel coordinates of the grid rows
+        depth (numpy.ndarray): distance along the ray to the hit point for each node (NaN if the ray misses)
+    """
+    def __init__(self, xs, ys, depth):
+        self.xs = xs
+        self.ys = ys
+        self.depth = depth
+        self.error = LookupGrid.interpolation_error(depth)
+
+    @staticmethod
+    def interpolation_error(depth):
+        """Estimate the error of interpolating depths inside each cell of a grid
+
+        Bilinear interpolation is exact where depth varies linearly along the rays, which holds on
+        planar surfaces (including slopes) at the scale of a cell. The error is estimated from the
+        second differences of depth at the corners of each cell: a depth discontinuity between
+        two nodes shows up as a large second difference on both of them.
+
+        Returns:
+            numpy.ndarray: (rows - 1, cols - 1) array of estimated errors (in depth units), NaN for cells next to misses
+        """
+        # Second differences at each node, repeating the nearest interior value at the borders
+        padded = np.pad(depth, 1, mode='edge')
+        dxx = np.abs(padded[1:-1, 2:] - 2 * padded[1:-1, 1:-1] + padded[1:-1, :-2])
+        dyy = np.abs(padded[2:, 1:-1] - 2 * padded[1:-1, 1:-1] + padded[:-2, 1:-1])
+        if depth.shape[1] > 2:
+            dxx[:, 0], dxx[:, -1] = dxx[:, 1], dxx[:, -2]
+        if depth.shape[0] > 2:
+            dyy[0, :], dyy[-1, :] = dyy[1, :], dyy[-2, :]
+        node = np.maximum(dxx, dyy)
+
+        # The maximum error of linear interpolation is a eighth of the second difference
+        corners = np.stack((node[:-1, :-1], node[:-1, 1:], node[1:, :-1], node[1:, 1:]))
+        with np.errstate(invalid='ignore'):
+            return corners.max(axis=0) / 8.0
+
+    @staticmethod
+    def nodes(width, height, spacing):
+        """Pixel coordinates of the nodes of a grid covering an image
+
+        Returns:
+            tuple: xs, ys, pixels where pixels is a (len(ys) * len(xs), 2) array in row-major order
+        """
+        xs = np.linspace(0, width, max(2, int(np.ceil(width / spacing)) + 1))
+        ys = np.linspace(0, height, max(2, int(np.ceil(height / spacing)) + 1))
+        gx, gy = np.meshgrid(xs, ys)
+        return xs, ys, np.column_stack((gx.ravel(), gy.ravel()))
+
+    def interpolate(self, pixels, tolerance):
+        """Bilinearly interpolate ray depths at pixel coordinates
+
+        Args:
+            pixels (numpy.ndarray): (N, 2) array of x,y pixel coordinates
+            tolerance (float): maximum estimated interpolation error of a grid cell (see :meth:`interpolation_error`).
+                Cells above this value are assumed to contain a depth discontinuity.
+
+        Returns:
+            tuple: depth, ok where ok is False for pixels outside of the grid, in cells with
+            missing hits or in cells with a depth discontinuity. These need to be raycast exactly.
+        """
+        px = pixels[:, 0]
+        py = pixels[:, 1]
+        ok = (px >= self.xs[0]) & (px <= self.xs[-1]) & (py >= self.ys[0]) & (py <= self.ys[-1])
+
+        i = np.clip(np.searchsorted(self.xs, px, side='right') - 1, 0, len(self.xs) - 2)
+        j = np.clip(np.searchsorted(self.ys, py, side='right') - 1, 0, len(self.ys) - 2)
+        fx = (px - self.xs[i]) / (self.xs[i + 1] - self.xs[i])
+        fy = (py - self.ys[j]) / (self.ys[j + 1] - self.ys[j])
+
+        d00, d01 = self.depth[j, i], self.depth[j, i + 1]
+        d10, d11 = self.depth[j + 1, i], self.depth[j + 1, i + 1]
+
+        with np.errstate(invalid='ignore'):
+            ok &= self.error[j, i] <= tolerance
+
+        depth = (d00 * (1 - fx) + d01 * fx) * (1 - fy) + (d10 * (1 - fx) + d11 * fx) * fy
+        return depth, ok
+
+    def save(self, path):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, xs=self.xs, ys=self.ys, depth=self.depth)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as f:
+            return LookupGrid(f['xs'], f['ys'], f['depth'])
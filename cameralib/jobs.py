@@ -0,0 +1,442 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import traceback
+import uuid
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from cameralib.projector import Projector, results_to_geometry
+from cameralib.utils import read_xanylabeling_annotation_file, read_yolov7_annotation_file
+from cameralib.exceptions import InvalidArgError, CannotProjectError
+
+
+logger = logging.getLogger(__name__)
+
+READERS = {
+    'xanylabeling': read_xanylabeling_annotation_file,
+    'yolov7': read_yolov7_annotation_file,
+}
+
+# Seconds between updates of the lock file of a shard that is being processed
+LOCK_REFRESH_INTERVAL = 10
+
+
+class ProjectionJob:
+    """A resumable batch projection of annotations to GeoJSON features.
+
+    The inputs are split into shards that are stored in the job directory. Any number of processes,
+    on one or more machines sharing the job directory, can run the job at the same time: each shard is
+    claimed with a lock file and marked done once its output has been written. Shards that were done
+    are skipped when a job is run again, so a crashed run can be resumed. A shard that raises an error is
+    marked failed (with the traceback in its .failed file) and the run goes on with the next shard.
+    Use :meth:`create` to start a job.
+
+    Args:
+        job_dir (str): Path to the job directory
+    """
+    def __init__(self, job_dir):
+        self.job_dir = os.path.abspath(job_dir)
+        manifest_file = os.path.join(self.job_dir, "job.json")
+        if not os.path.isfile(manifest_file):
+            raise InvalidArgError(f"{manifest_file} does not exist")
+
+        with open(manifest_file, 'r') as f:
+            self.manifest = json.load(f)
+
+        self.project_path = self.manifest['project_path']
+        self.format = self.manifest['format']
+        self.shards = self.manifest['shards']
+        self._lock_tokens = {} # shard --> token written in the locks held by this process
+
+    @staticmethod
+    def create(job_dir, project_path, inputs, format='xanylabeling', shard_size=100, image_suffix='.JPG', projector_args=None):
+        """Create a new job
+
+        Args:
+            job_dir (str): Path to the job directory. It must not contain a job already.
+            project_path (str): Path to ODM project
+            inputs (list): label file paths, or annotation records as returned by the readers in :mod:`cameralib.utils`
+            format (str): One of: ['xanylabeling', 'yolov7', 'records']
+            shard_size (int): Number of inputs in each shard
+            image_suffix (str): Extension of the target images (for yolov7 labels)
+            projector_args (dict): Arguments passed to :class:`Projector`
+
+        Returns:
+            ProjectionJob: the job
+        """
+        if format != 'records' and format not in READERS:
+            raise InvalidArgError(f"Invalid format {format}")
+        if shard_size <= 0:
+            raise InvalidArgError("shard_size must be > 0")
+
+        job_dir = os.path.abspath(job_dir)
+        manifest_file = os.path.join(job_dir, "job.json")
+        if os.path.isfile(manifest_file):
+            raise InvalidArgError(f"{job_dir} already contains a job")
+
+        if format != 'records':
+            # Workers on other machines or directories must find the files
+            inputs = [os.path.abspath(i) for i in inputs]
+
+        shards_dir = os.path.join(job_dir, "shards")
+        os.makedirs(shards_dir, exist_ok=True)
+
+        shards = []
+        for i in range(0, len(inputs), shard_size):
+            name = f"{len(shards):06d}"
+            _write_json(os.path.join(shards_dir, f"{name}.json"), inputs[i:i + shard_size])
+            shards.append(name)
+
+        _write_json(manifest_file, {
+            'project_path': os.path.abspath(project_path),
+            'format': format,
+            'image_suffix': image_suffix,
+            'projector_args': projector_args or {},
+            'inputs': len(inputs),
+            'shards': shards,
+        })
+
+        return ProjectionJob(job_dir)
+
+    def _path(self, shard, ext):
+        return os.path.join(self.job_dir, "shards", f"{shard}.{ext}")
+
+    def _claim(self, shard, stale_after, retry_failed):
+        if os.path.isfile(self._path(shard, "done")):
+            return False
+        if not retry_failed and os.path.isfile(self._path(shard, "failed")):
+            return False
+
+        lock_file = self._path(shard, "lock")
+        if stale_after is not None:
+            self._reclaim(shard, stale_after)
+
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        token = uuid.uuid4().hex
+        self._lock_tokens[shard] = token
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(), 'token': token}))
+
+        # Another worker might have finished the shard between our check and the lock
+        if os.path.isfile(self._path(shard, "done")):
+            self._release(shard)
+            return False
+
+        return True
+
+    def _fail(self, shard, error):
+        logger.error(f"Shard {shard} failed: {str(error)}")
+        _write_json(self._path(shard, "failed"), {
+            'shard': shard,
+            'error': str(error),
+            'traceback': traceback.format_exc(),
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'time': time.time(),
+        })
+
+    def _reclaim(self, shard, stale_after):
+        lock_file = self._path(shard, "lock")
+        try:
+            st = os.stat(lock_file)
+        except FileNotFoundError:
+            return
+        if time.time() - st.st_mtime <= stale_after:
+            return
+
+        # Move the lock away atomically, then check that it's the stale lock and not
+        # a fresh one created by a worker that reclaimed the shard in the meantime
+        moved_file = f"{lock_file}.{socket.gethostname()}.{os.getpid()}.stale"
+        try:
+            os.rename(lock_file, moved_file)
+        except FileNotFoundError:
+            return
+
+        moved = os.stat(moved_file)
+        if (moved.st_ino, moved.st_mtime_ns) == (st.st_ino, st.st_mtime_ns):
+            logger.warning(f"Reclaiming stale shard {shard}")
+        else:
+            try:
+                os.link(moved_file, lock_file)
+            except FileExistsError:
+                pass
+        os.remove(moved_file)
+
+    def _release(self, shard):
+        # Only remove our own lock, the shard might have been reclaimed by another worker
+        lock_file = self._path(shard, "lock")
+        token = self._lock_tokens.pop(shard, None)
+        try:
+            with open(lock_file, 'r') as f:
+                owner = json.load(f).get('token')
+            if owner == token:
+                os.remove(lock_file)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def _read_shard(self, shard):
+        with open(self._path(shard, "json"), 'r') as f:
+            inputs = json.load(f)
+
+        if self.format == 'records':
+            return inputs
+
+        read = READERS[self.format]
+        annotations = []
+        for label_file in inputs:
+            if self.format == 'yolov7':
+                annotations += read(label_file, self.manifest['image_suffix'])
+            else:
+                annotations += read(label_file)
+        return annotations
+
+    def _run_shard(self, projector, shard):
+        start = time.time()
+        annotations = self._read_shard(shard)
+
+        # Raycast the vertices of all annotations of an image in a single batch
+        groups = {}
+        for i, a in enumerate(annotations):
+            if len(a['coordinates']) > 0:
+                groups.setdefault((a['image'], a.get('normalized', False)), []).append(i)
+
+        results = [None] * len(annotations)
+        for (image, normalized), idx in groups.items():
+            coordinates = [np.array(annotations[i]['coordinates'], dtype=np.float64).reshape((-1, 2)) for i in idx]
+            try:
+                points = projector.cam2world_array(image, np.concatenate(coordinates), normalized)
+            except (InvalidArgError, CannotProjectError) as e:
+                logger.warning(f"Cannot project annotations in {image}: {str(e)}")
+                continue
+
+            offsets = np.cumsum([0] + [len(c) for c in coordinates])
+            for k, i in enumerate(idx):
+                results[i] = points[offsets[k]:offsets[k + 1]]
+
+        lines = []
+        failed = 0
+        for a, r in zip(annotations, results):
+            if r is None or len(r) == 0 or np.any(np.isnan(r)):
+                logger.warning(f"Cannot project annotation in {a['image']}")
+                failed += 1
+                continue
+
+            properties = dict(a.get('properties', {}))
+            properties.setdefault('image', a['image'])
+            lines.append(json.dumps({
+                'type': 'Feature',
+                'properties': properties,
+                'geometry': results_to_geometry(r.tolist())
+            }))
+
+        _write_text(self._path(shard, "ndjson"), "".join(l + "\n" for l in lines))
+
+        seconds = time.time() - start
+        stats = {
+            'shard': shard,
+            'annotations': len(annotations),
+            'features': len(lines),
+            'failed': failed,
+            'seconds': seconds,
+            'throughput': len(annotations) / seconds if seconds > 0 else 0.0,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+        }
+        _write_json(self._path(shard, "done"), stats)
+        try:
+            os.remove(self._path(shard, "failed"))
+        except FileNotFoundError:
+            pass
+        self._release(shard)
+
+        logger.info(f"Shard {shard}: {len(annotations)} annotations in {seconds:.2f}s ({stats['throughput']:.1f}/s), {failed} failed")
+        return stats
+
+    def run(self, workers=1, stale_after=None, retry_failed=False):
+        """Process the shards that are not done yet
+
+        Args:
+            workers (int): Number of worker processes
+            stale_after (float): Seconds after which a shard claimed by another worker is considered
+                abandoned (for example because the worker crashed) and is processed again. Workers refresh
+                the lock of the shard they are processing every LOCK_REFRESH_INTERVAL seconds, so this must
+                be at least three times that. By default claimed shards are never taken over; remove their
+                .lock files to process them again.
+            retry_failed (bool): Whether to process shards that failed in a previous run again
+
+        Returns:
+            list of dict: statistics for each shard processed by this call, with the following information:
+            [
+                {
+                    'shard': str            # Shard name
+
+                    'annotations': int      # Number of annotations read
+
+                    'features': int         # Number of features written
+
+                    'failed': int           # Number of annotations that could not be projected
+
+                    'seconds': float        # Processing time
+
+                    'throughput': float     # Annotations per second
+                }
+            ]
+        """
+        if workers <= 0:
+            raise InvalidArgError("workers must be > 0")
+        if stale_after is not None and stale_after < 3 * LOCK_REFRESH_INTERVAL:
+            raise InvalidArgError(f"stale_after must be >= {3 * LOCK_REFRESH_INTERVAL}")
+
+        if workers == 1:
+            return _run_worker(self.job_dir, stale_after, retry_failed)
+
+        stats = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for s in executor.map(_run_worker, [self.job_dir] * workers, [stale_after] * workers, [retry_failed] * workers):
+                stats += s
+        return sorted(stats, key=lambda s: s['shard'])
+
+    def status(self):
+        """Progress of the job
+
+        Returns:
+            dict: number of shards that are done, claimed (in progress or abandoned), failed and pending,
+            the statistics of the shards that are done and the errors of the shards that failed
+        """
+        done = []
+        errors = []
+        claimed = 0
+        for shard in self.shards:
+            try:
+                with open(self._path(shard, "done"), 'r') as f:
+                    done.append(json.load(f))
+                continue
+            except FileNotFoundError:
+                pass
+
+            if os.path.isfile(self._path(shard, "lock")):
+                claimed += 1
+            elif os.path.isfile(self._path(shard, "failed")):
+                with open(self._path(shard, "failed"), 'r') as f:
+                    errors.append(json.load(f))
+
+        return {
+            'shards': len(self.shards),
+            'done': len(done),
+            'claimed': claimed,
+            'failed_shards': len(errors),
+            'pending': len(self.shards) - len(done) - claimed - len(errors),
+            'annotations': sum(s['annotations'] for s in done),
+            'failed': sum(s['failed'] for s in done),
+            'stats': done,
+            'errors': errors,
+        }
+
+    def merge(self, output_path, skip_failed=False):
+        """Merge the outputs of all shards. Shards are read one at a time.
+
+        Args:
+            output_path (str): Path of the output file. Files ending in .ndjson, .geojsonl or .jsonl
+                are written as newline delimited GeoJSON, others as a GeoJSON FeatureCollection.
+            skip_failed (bool): Whether to merge the shards that are done when some shards failed
+
+        Returns:
+            int: number of features written
+        """
+        pending = [s for s in self.shards if not os.path.isfile(self._path(s, "done"))]
+        failed = [s for s in pending if os.path.isfile(self._path(s, "failed")) and not os.path.isfile(self._path(s, "lock"))]
+        if skip_failed:
+            for s in failed:
+                logger.warning(f"Skipping failed shard {s}")
+            pending = [s for s in pending if s not in failed]
+        if len(pending) > 0:
+            raise InvalidArgError(f"{len(pending)} shards are not done yet ({len(failed)} failed)")
+
+        delimited = os.path.splitext(output_path)[1].lower() in ['.ndjson', '.geojsonl', '.jsonl']
+        count = 0
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            if not delimited:
+                out.write('{"type": "FeatureCollection", "features": [\n')
+
+            for shard in self.shards:
+                if not os.path.isfile(self._path(shard, "done")):
+                    continue
+                with open(self._path(shard, "ndjson"), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        line = line.rstrip("\n")
+                        if line == "":
+                            continue
+                        if not delimited and count > 0:
+                            out.write(",\n")
+                        out.write(line)
+                        if delimited:
+                            out.write("\n")
+                        count += 1
+
+            if not delimited:
+                out.write("\n]}\n")
+
+        os.replace(tmp_path, output_path)
+        return count
+
+
+def _run_worker(job_dir, stale_after, retry_failed):
+    job = ProjectionJob(job_dir)
+    projector = None
+    stats = []
+
+    for shard in job.shards:
+        if not job._claim(shard, stale_after, retry_failed):
+            continue
+
+        try:
+            if projector is None:
+                projector = Projector(job.project_path, **job.manifest['projector_args'])
+        except BaseException:
+            job._release(shard)
+            raise
+
+        stop = threading.Event()
+        refresh = threading.Thread(target=_refresh_lock, args=(job._path(shard, "lock"), stop), daemon=True)
+        refresh.start()
+        try:
+            stats.append(job._run_shard(projector, shard))
+        except Exception as e:
+            # Errors of a shard (for example a malformed label file) do not stop the other shards
+            job._fail(shard, e)
+            job._release(shard)
+        except BaseException:
+            job._release(shard)
+            raise
+        finally:
+            stop.set()
+            refresh.join()
+
+    return stats
+
+def _refresh_lock(lock_file, stop):
+    # Tell other workers that the shard is still being processed
+    while not stop.wait(LOCK_REFRESH_INTERVAL):
+        try:
+            os.utime(lock_file)
+        except FileNotFoundError:
+            return
+
+def _write_text(path, text):
+    # Write to a temporary file first, so that readers never see partial outputs
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def _write_json(path, data):
+    _write_text(path, json.dumps(data))
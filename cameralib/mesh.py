@@ -0,0 +1,200 @@
+import os
+import numpy as np
+from cameralib.exceptions import InvalidArgError
+
+
+def load_obj(obj_path):
+    """Read vertices and triangles from a Wavefront OBJ file. Polygons are triangulated as fans.
+
+    Returns:
+        tuple: (vertices, faces) as (N, 3) float and (M, 3) int arrays
+    """
+    vertices = []
+    faces = []
+    with open(obj_path, 'r') as f:
+        for line in f:
+            if line.startswith('v '):
+                vertices.append(line[2:].split()[:3])
+            elif line.startswith('f '):
+                idx = [int(p.split('/')[0]) for p in line[2:].split()]
+                for i in range(1, len(idx) - 1):
+                    faces.append((idx[0], idx[i], idx[i + 1]))
+
+    if len(vertices) == 0 or len(faces) == 0:
+        raise InvalidArgError(f"{obj_path} does not contain a triangle mesh")
+
+    vertices = np.array(vertices, dtype=np.float64)
+    faces = np.array(faces, dtype=np.int64)
+
+    # OBJ indices are 1-based, negative indices are relative to the end
+    faces = np.where(faces < 0, faces + len(vertices), faces - 1)
+    return vertices, faces
+
+def read_odm_offset(project_path):
+    """Read the georeferencing offset of an ODM project from odm_georeferencing/coords.txt
+
+    Returns:
+        numpy.ndarray: x,y,z offset, or None if the file is not available
+    """
+    coords_file = os.path.join(project_path, "odm_georeferencing", "coords.txt")
+    if not os.path.isfile(coords_file):
+        return None
+
+    with open(coords_file, 'r') as f:
+        lines = f.read().split("\n")
+    try:
+        x, y = [float(v) for v in lines[1].split()[:2]]
+        return np.array([x, y, 0.0])
+    except (IndexError, ValueError):
+        return None
+
+
+class Mesh:
+    """A triangle mesh with a bounding volume hierarchy for ray intersection
+
+    Args:
+        vertices (numpy.ndarray): (N, 3) array of vertex coordinates
+        faces (numpy.ndarray): (M, 3) array of vertex indices
+        leaf_size (int): Maximum number of triangles in a leaf node of the hierarchy
+    """
+    def __init__(self, vertices, faces, leaf_size=8):
+        # Work relative to the mesh center to preserve precision with projected coordinates
+        self.origin = vertices.mean(axis=0)
+        tris = (vertices - self.origin)[faces]
+        self.min_bound = tris.reshape((-1, 3)).min(axis=0) + self.origin
+        self.max_bound = tris.reshape((-1, 3)).max(axis=0) + self.origin
+
+        self._build(tris, leaf_size)
+
+    def _build(self, tris, leaf_size):
+        centroids = tris.mean(axis=1)
+        tri_min = tris.min(axis=1)
+        tri_max = tris.max(axis=1)
+        order = np.arange(len(tris))
+
+        bmin, bmax, left, right, start, count = [], [], [], [], [], []
+        stack = [(0, len(tris), -1, False)] # start, end, parent, is right child
+
+        while stack:
+            lo, hi, parent, is_right = stack.pop()
+            node = len(bmin)
+            idx = order[lo:hi]
+            bmin.append(tri_min[idx].min(axis=0))
+            bmax.append(tri_max[idx].max(axis=0))
+            left.append(-1)
+            right.append(-1)
+            start.append(lo)
+            count.append(0)
+
+            if parent >= 0:
+                if is_right:
+                    right[parent] = node
+                else:
+                    left[parent] = node
+
+            if hi - lo <= leaf_size:
+                count[node] = hi - lo
+                continue
+
+            # Split at the median centroid along the longest axis
+            c = centroids[idx]
+            axis = np.argmax(c.max(axis=0) - c.min(axis=0))
+            mid = (hi - lo) // 2
+            order[lo:hi] = idx[np.argpartition(c[:, axis], mid)]
+            stack.append((lo + mid, hi, node, True))
+            stack.append((lo, lo + mid, node, False))
+
+        self.node_min = np.array(bmin)
+        self.node_max = np.array(bmax)
+        self.node_left = np.array(left, dtype=np.int64)
+        self.node_right = np.array(right, dtype=np.int64)
+        self.node_start = np.array(start, dtype=np.int64)
+        self.node_count = np.array(count, dtype=np.int64)
+
+        tris = tris[order]
+        self.v0 = tris[:, 0]
+        self.e1 = tris[:, 1] - tris[:, 0]
+        self.e2 = tris[:, 2] - tris[:, 0]
+
+    def intersect(self, origins, directions, chunk_size=4096):
+        """Find the closest intersection of rays with the mesh
+
+        Args:
+            origins (numpy.ndarray): (N, 3) or (3, ) ray origins
+            directions (numpy.ndarray): (N, 3) ray directions
+            chunk_size (int): Number of rays traversed together
+
+        Returns:
+            numpy.ndarray: distance along each ray to the closest hit (in units of the direction vector), inf for misses
+        """
+        directions = np.asarray(directions, dtype=np.float64)
+        origins = np.broadcast_to(np.asarray(origins, dtype=np.float64) - self.origin, directions.shape)
+        t = np.full(len(directions), np.inf)
+
+        for i in range(0, len(directions), chunk_size):
+            t[i:i + chunk_size] = self._intersect(origins[i:i + chunk_size], directions[i:i + chunk_size])
+
+        return t
+
+    def _intersect(self, origins, directions):
+        best_t = np.full(len(directions), np.inf)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_dir = 1.0 / directions
+
+        # Breadth first traversal of (ray, node) pairs
+        rays = np.arange(len(directions))
+        nodes = np.zeros(len(directions), dtype=np.int64)
+
+        while len(rays) > 0:
+            o = origins[rays]
+            inv = inv_dir[rays]
+            with np.errstate(invalid='ignore'):
+                t1 = (self.node_min[nodes] - o) * inv
+                t2 = (self.node_max[nodes] - o) * inv
+            tnear = np.nanmax(np.minimum(t1, t2), axis=1)
+            tfar = np.nanmin(np.maximum(t1, t2), axis=1)
+
+            keep = (tnear <= tfar) & (tfar >= 0) & (tnear < best_t[rays])
+            rays = rays[keep]
+            nodes = nodes[keep]
+
+            leaf = self.node_count[nodes] > 0
+            if np.any(leaf):
+                self._intersect_leaves(origins, directions, rays[leaf], nodes[leaf], best_t)
+
+            inner = ~leaf
+            rays = np.concatenate((rays[inner], rays[inner]))
+            nodes = np.concatenate((self.node_left[nodes[inner]], self.node_right[nodes[inner]]))
+
+        return best_t
+
+    def _intersect_leaves(self, origins, directions, rays, nodes, best_t):
+        counts = self.node_count[nodes]
+        pair_rays = np.repeat(rays, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        tris = np.repeat(self.node_start[nodes], counts) + offsets
+
+        t = moller_trumbore(origins[pair_rays], directions[pair_rays], self.v0[tris], self.e1[tris], self.e2[tris])
+        np.minimum.at(best_t, pair_rays, t)
+
+
+def moller_trumbore(origins, directions, v0, e1, e2, eps=1e-9):
+    """Vectorized Möller–Trumbore ray/triangle intersection
+
+    Returns:
+        numpy.ndarray: distance along each ray to its triangle, inf for misses
+    """
+    p = np.cross(directions, e2)
+    det = np.einsum('ij,ij->i', e1, p)
+    valid = np.abs(det) > eps
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_det = 1.0 / det
+        tvec = origins - v0
+        u = np.einsum('ij,ij->i', tvec, p) * inv_det
+        q = np.cross(tvec, e1)
+        v = np.einsum('ij,ij->i', directions, q) * inv_det
+        t = np.einsum('ij,ij->i', e2, q) * inv_det
+        valid &= (u >= 0) & (v >= 0) & (u + v <= 1) & (t > eps)
+
+    return np.where(valid, t, np.inf)
@@ -0,0 +1,165 @@
+import os
+import math
+import logging
+import cv2
+import numpy as np
+import rasterio
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from rasterio.enums import ColorInterp
+from cameralib.camera import shots_to_arrays, project_to_shots, distort_pixels
+from cameralib.exceptions import InvalidArgError, CannotProjectError
+
+
+logger = logging.getLogger(__name__)
+
+
+def orthorectify(projector, image, output_path, resolution=None, tile_size=512, workers=1, image_path=None, footprint_samples=32):
+    """Orthorectify a single image onto the elevation model and write it as a GeoTIFF.
+    The ground footprint of the image is processed in tiles, so memory usage is bounded by the tile size
+    and the number of workers. Occlusions are not taken into account.
+
+    Args:
+        projector (Projector): projector for the ODM project
+        image (str): image filename
+        output_path (str): path of the GeoTIFF to write
+        resolution (float): ground resolution of the output, in DEM units. Defaults to the DEM resolution.
+        tile_size (int): size in pixels of the tiles processed at once. Must be a multiple of 16.
+        workers (int): number of tiles processed in parallel
+        image_path (str): path to the image file. Defaults to the images directory of the project.
+        footprint_samples (int): number of points raycast along each side of the image to find its footprint
+
+    Returns:
+        str: output_path
+    """
+    if not image in projector.shots_map:
+        raise InvalidArgError(f"Image {image} not found in {projector.shots_path}")
+    if tile_size <= 0 or tile_size % 16 != 0:
+        raise InvalidArgError("tile_size must be a positive multiple of 16")
+
+    s = projector.shots[projector.shots_map[image]]
+    cam = projector._shot_camera(s)
+
+    if image_path is None:
+        image_path = os.path.join(projector.project_path, "images", image)
+    img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError(f"Cannot read {image_path}")
+    if img.ndim == 2:
+        img = img[:, :, None]
+    elif img.shape[2] >= 3:
+        img = cv2.cvtColor(img[:, :, :3], cv2.COLOR_BGR2RGB)
+
+    # Images might have been resized after processing
+    img_scale = (img.shape[1] / s['width'], img.shape[0] / s['height'])
+
+    projector._read_dem()
+    if resolution is None:
+        resolution = projector.dem.resolution
+
+    minx, miny, maxx, maxy = _footprint_bounds(projector, image, s, footprint_samples)
+    minx = math.floor(minx / resolution) * resolution
+    maxy = math.ceil(maxy / resolution) * resolution
+    width = max(1, int(math.ceil((maxx - minx) / resolution)))
+    height = max(1, int(math.ceil((maxy - miny) / resolution)))
+    transform = from_origin(minx, maxy, resolution, resolution)
+
+    bands = img.shape[2]
+    profile = {
+        'driver': 'GTiff',
+        'width': width,
+        'height': height,
+        'count': bands + 1,
+        'dtype': img.dtype.name,
+        'crs': projector.dem.crs,
+        'transform': transform,
+        'tiled': True,
+        'blockxsize': tile_size,
+        'blockysize': tile_size,
+        'compress': 'deflate',
+    }
+
+    windows = [Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+                for row in range(0, height, tile_size)
+                for col in range(0, width, tile_size)]
+    shot_arrays = shots_to_arrays([s])
+
+    def process(window):
+        return window, _ortho_tile(projector, s, cam, shot_arrays, img, img_scale, transform, window)
+
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        if bands >= 3:
+            dst.colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue] + [ColorInterp.undefined] * (bands - 3) + [ColorInterp.alpha]
+        else:
+            dst.colorinterp = [ColorInterp.gray] * bands + [ColorInterp.alpha]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Keep a bounded number of tiles in flight
+            pending = []
+            for w in windows:
+                pending.append(executor.submit(process, w))
+                if len(pending) >= workers * 2:
+                    _write_tile(dst, *pending.pop(0).result())
+            for f in pending:
+                _write_tile(dst, *f.result())
+
+    return output_path
+
+def _footprint_bounds(projector, image, s, samples):
+    t = np.linspace(0, 1, samples)
+    w, h = s['width'], s['height']
+    border = np.concatenate([
+        np.column_stack((t * w, np.zeros(samples))),
+        np.column_stack((np.full(samples, w), t * h)),
+        np.column_stack((t * w, np.full(samples, h))),
+        np.column_stack((np.zeros(samples), t * h)),
+    ])
+
+    cam = projector._shot_camera(s)
+    rays_world = projector._shot_rays(s, cam, border)
+    down = rays_world[:, 2] <= 0
+    points, hits = projector._raycast_pixels(image, s, cam, border[down], rays_world[down])
+    if not np.any(hits):
+        raise CannotProjectError(f"The footprint of {image} does not intersect the elevation model")
+
+    xy = points[hits, :2]
+    return xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(), xy[:, 1].max()
+
+def _ortho_tile(projector, s, cam, shot_arrays, img, img_scale, transform, window):
+    cols, rows = np.meshgrid(np.arange(window.col_off, window.col_off + window.width),
+                             np.arange(window.row_off, window.row_off + window.height))
+    xs, ys = transform * (cols.ravel() + 0.5, rows.ravel() + 0.5)
+    xs = np.asarray(xs)
+    ys = np.asarray(ys)
+
+    z = projector._sample_z(xs, ys)
+    has_z = z != projector.dem_nodata
+
+    x, y, inside = project_to_shots(shot_arrays, np.column_stack((xs, ys, z)))
+    x, y, inside = x[0], y[0], inside[0] & has_z
+
+    map_x = np.full(len(xs), -1, dtype=np.float32)
+    map_y = np.full(len(xs), -1, dtype=np.float32)
+    valid = np.zeros(len(xs), dtype=bool)
+    if np.any(inside):
+        xu, yu, v = distort_pixels(cam, x[inside], y[inside], s['width'], s['height'], round_pixels=False)
+        map_x[inside] = xu * img_scale[0]
+        map_y[inside] = yu * img_scale[1]
+        valid[inside] = v
+
+    if not np.any(valid):
+        return None
+
+    shape = (window.height, window.width)
+    out = cv2.remap(img, map_x.reshape(shape), map_y.reshape(shape), cv2.INTER_LINEAR,
+                    borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    if out.ndim == 2:
+        out = out[:, :, None]
+
+    alpha = np.where(valid.reshape(shape), np.iinfo(img.dtype).max if np.issubdtype(img.dtype, np.integer) else 1, 0).astype(img.dtype)
+    return np.concatenate((np.moveaxis(out, 2, 0), alpha[None]), axis=0)
+
+def _write_tile(dst, window, data):
+    if data is not None:
+        dst.write(data, window=window)
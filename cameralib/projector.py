@@ -1,16 +1,24 @@
 import os
 import json
+import time
+import hashlib
+import threading
 import numpy as np
-from scipy import ndimage
-import rasterio
 import logging
-from cameralib.geo import get_utm_xyz, get_latlon, raster_sample_z
-from cameralib.camera import load_shots, load_cameras, map_pixels
+from concurrent.futures import Future, wait
+from cameralib.geo import get_utm_xy, get_utm_xy_many, get_latlon_many
+from cameralib.grid import LookupGrid
+from cameralib.dem import open_dem, is_mosaic
+from cameralib.cache import LRUCache
+from cameralib.mesh import Mesh, load_obj, read_odm_offset
+from cameralib.camera import read_shots_properties, parse_shot, read_cameras, parse_camera, shots_to_arrays, project_to_shots, distort_pixels
 from cameralib.exceptions import *
 
 
 logger = logging.getLogger(__name__)
 
+_MISS = object()
+
 
 class Projector:
     """A projector to perform camera coordinates operations on ODM datasets
@@ -19,12 +27,28 @@ class Projector:
         project_path (str): Path to ODM project
         z_sample_window (int): Size of the window to use when sampling elevation values
         z_sample_strategy (str): Strategy to use when sampling elevation values. Can be one of: ['minimum', 'maximum', 'average', 'median']
-        z_sample_target (str): Elevation raster to use for sampling elevation. One of: ['dsm', 'dtm']
+        z_sample_target (str): Surface to use for sampling elevation. One of: ['dsm', 'dtm', 'mesh']. With 'mesh', rays are intersected with the textured mesh; the DSM is still used for georeferencing.
         z_fill_nodata: Whether to fill nodata cells with nearest neighbor cell values. This gives a wider coverage for queries, but increases the initialization time.
         raycast_resolution_multiplier (float): Value that affects the ray sampling resolution. Lower values can lead to slightly more precise results, but increase processing time.
-        dem_path (str): Manually set a path to a valid GeoTIFF DEM for sampling Z values instead of using the default.
+        dem_path (str or list): Manually set a path to a valid GeoTIFF DEM for sampling Z values instead of using the default. Can also be a directory of GeoTIFF tiles, a VRT or a list of tile paths, in which case tiles are read on demand.
+        dem_max_open_tiles (int): Maximum number of DEM tiles kept in memory when dem_path is a set of tiles.
+        mesh_path (str): Manually set a path to an OBJ mesh to use when z_sample_target is 'mesh'. Defaults to odm_texturing/odm_textured_model_geo.obj
+        lookup_grid_spacing (float): If set, raycast a regular grid of pixels spaced by this many pixels once per image and answer cam2world queries by interpolating it. Queries near depth discontinuities are still raycast exactly.
+        lookup_grid_z_tolerance (float): Maximum estimated interpolation error (in DEM units) of a lookup grid cell, from the curvature of ray depths at its corners. Cells above it contain a depth discontinuity and are raycast exactly. Slopes do not count towards the error.
+        lookup_grid_cache_dir (str): Optional directory where lookup grids are saved and reused across runs.
+        lookup_grid_cache_size (int): Maximum number of lookup grids kept in memory. Grids that are evicted are built again, or read from lookup_grid_cache_dir.
+        dem_dtype (str): Storage type of the DEM in memory. One of: [None, 'float32', 'int16', 'uint16']. None keeps the type of the GeoTIFF. Integer types quantize elevations with dem_z_scale precision and reduce memory usage.
+        dem_z_scale (float): Precision of quantized elevations when dem_dtype is 'int16' or 'uint16', in DEM units.
+        query_cache_size (int): Maximum number of cam2world points and world2cams locations to memoize. 0 disables the cache.
+        query_cache_precision (float): Pixel coordinates are rounded to this value (in pixels) to form cam2world cache keys.
+        query_cache_geo_precision (float): Geographic coordinates are rounded to this value (in degrees) to form world2cams cache keys.
+        preload (str): When to load the DEM and the mesh. One of: [None, 'eager', 'background']. None loads them on the first query,
+            'eager' loads them in the constructor and 'background' starts :meth:`warmup` from the constructor.
     """
-    def __init__(self, project_path, z_sample_window=1, z_sample_strategy='median', z_sample_target='dsm', z_fill_nodata=True, raycast_resolution_multiplier=0.7071, dem_path=None):
+    def __init__(self, project_path, z_sample_window=1, z_sample_strategy='median', z_sample_target='dsm', z_fill_nodata=True, raycast_resolution_multiplier=0.7071, dem_path=None, mesh_path=None,
+                 lookup_grid_spacing=None, lookup_grid_z_tolerance=0.1, lookup_grid_cache_dir=None, lookup_grid_cache_size=64,
+                 dem_dtype=None, dem_z_scale=0.01, dem_max_open_tiles=16,
+                 query_cache_size=0, query_cache_precision=0.01, query_cache_geo_precision=1e-7, preload=None):
         if not os.path.isdir(project_path):
             raise IOError(f"{project_path} is not a valid path to an ODM project")
         
@@ -33,54 +57,339 @@ class Projector:
         self.z_sample_strategy = z_sample_strategy
         self.z_fill_nodata = z_fill_nodata
         self.raycast_resolution_multiplier = raycast_resolution_multiplier
+        self.lookup_grid_spacing = lookup_grid_spacing
+        self.lookup_grid_z_tolerance = lookup_grid_z_tolerance
+        self.lookup_grid_cache_dir = lookup_grid_cache_dir
 
         if self.z_sample_window % 2 == 0 or self.z_sample_window <= 0:
             raise InvalidArgError("z_sample_window must be an odd number > 0")
+        if self.lookup_grid_spacing is not None and self.lookup_grid_spacing <= 0:
+            raise InvalidArgError("lookup_grid_spacing must be > 0")
+        if lookup_grid_cache_size <= 0:
+            raise InvalidArgError("lookup_grid_cache_size must be > 0")
+        if preload not in [None, 'eager', 'background']:
+            raise InvalidArgError(f"Invalid preload {preload}")
 
         self.dsm_path = os.path.abspath(os.path.join(project_path, "odm_dem", "dsm.tif"))
         self.dtm_path = os.path.abspath(os.path.join(project_path, "odm_dem", "dtm.tif"))
 
+        self.z_sample_target = z_sample_target
+        self.mesh_path = None
+        self.mesh = None
+        self._mesh_lock = threading.Lock()
+        if z_sample_target == 'mesh':
+            if mesh_path is not None:
+                self.mesh_path = mesh_path
+            else:
+                self.mesh_path = os.path.abspath(os.path.join(project_path, "odm_texturing", "odm_textured_model_geo.obj"))
+            if not os.path.isfile(self.mesh_path):
+                raise InvalidArgError(f"{self.mesh_path} does not exist")
+
         if dem_path is not None:
             self.dem_path = dem_path
         else:
-            if z_sample_target == 'dsm':
+            if z_sample_target == 'dsm' or z_sample_target == 'mesh':
                 self.dem_path = self.dsm_path
             elif z_sample_target == 'dtm':
                 self.dem_path = self.dtm_path
             else:
                 raise InvalidArgError(f"Invalid z_sample_target {z_sample_target}")
 
-        if not os.path.isfile(self.dem_path):
+        if not is_mosaic(self.dem_path) and not os.path.isfile(self.dem_path):
             raise InvalidArgError(f"{self.dem_path} does not exist. A surface model is required.")
-        with rasterio.open(self.dem_path, "r") as r:
-            self.dem_nodata = r.nodata
+        self._dem_args = {'fill_nodata': self.z_fill_nodata, 'dtype': dem_dtype, 'z_scale': dem_z_scale, 'max_open_tiles': dem_max_open_tiles}
+        self.dem = open_dem(self.dem_path, **self._dem_args)
+        self._owns_dem = True
 
         self.shots_path = os.path.abspath(os.path.join(project_path, "odm_report", "shots.geojson"))
         self.cameras_path = os.path.abspath(os.path.join(project_path, "cameras.json"))
 
-        self.shots, self.shots_map = load_shots(self.shots_path)
-        self.cameras = load_cameras(self.cameras_path)
+        self._sources = {}
+        self._shot_arrays_cache = None
+        self._shot_props = {}
+        self._camera_props = {}
+        self._source_changed(self.shots_path)
+        self._source_changed(self.cameras_path)
+        self._load_shots()
+        self._load_cameras()
+
+        self._lookup_grids = LRUCache(lookup_grid_cache_size)
+
+        self.query_cache_precision = query_cache_precision
+        self.query_cache_geo_precision = query_cache_geo_precision
+        self.query_cache = LRUCache(query_cache_size) if query_cache_size > 0 else None
+        self._cache_token = None
+
+        self._warmup_future = None
+        self._warmup_grids = False
+        self._warmup_lock = threading.Lock()
+        if preload == 'eager':
+            self._warmup()
+        elif preload == 'background':
+            self.warmup()
+
+    @property
+    def raster(self):
+        return self.dem.raster
+
+    @property
+    def dem_data(self):
+        return self.dem.data
 
-        self.raster = None
-        self.dem_data = None
-        self.min_z = None
+    @property
+    def dem_nodata(self):
+        return self.dem.data_nodata
+
+    @property
+    def min_z(self):
+        return self.dem.min_z
     
     def _read_dem(self):
-        if self.raster is None:
-            self.raster = rasterio.open(self.dem_path, 'r')
-            self.dem_data = self.raster.read(1)
-            valid_mask = self.dem_data!=self.raster.nodata
-            self.min_z = self.dem_data[valid_mask].min()
-            if self.z_fill_nodata:
-                indices = ndimage.distance_transform_edt(~valid_mask, 
-                                                    return_distances=False, 
-                                                    return_indices=True)
-                self.dem_data = self.dem_data[tuple(indices)]
+        self.dem.load()
+        if self.z_sample_target == 'mesh':
+            self._read_mesh()
+        self._check_cache_token()
+
+    def warmup(self, lookup_grids=False):
+        """Load the DEM, the mesh and the data used by queries on a background thread, so that
+        the first queries do not pay for it. Queries that run in the meantime wait only for the
+        data they need: the DEM and the mesh are loaded under separate locks.
+
+        Args:
+            lookup_grids (bool): Also build the lookup grids of the images, when lookup_grid_spacing is set. Without
+                lookup_grid_cache_dir, only as many grids as fit in lookup_grid_cache_size are built.
+
+        Returns:
+            concurrent.futures.Future: completes when everything is loaded, with the number of seconds it took.
+            Errors raised while loading are set on the future. If a warm-up is already running and covers
+            the requested work, its future is returned.
+        """
+        with self._warmup_lock:
+            previous = self._warmup_future
+            if previous is not None and not previous.done():
+                if self._warmup_grids or not lookup_grids:
+                    return previous
+            else:
+                previous = None
+
+            # A warm-up without lookup grids is already running: chain the
+            # grids onto it rather than loading the same data twice
+            future = Future()
+            def run():
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    if previous is not None:
+                        wait([previous])
+                    future.set_result(self._warmup(lookup_grids))
+                except BaseException as e:
+                    logger.warning(f"Cannot warm up {self.project_path}: {str(e)}")
+                    future.set_exception(e)
+
+            self._warmup_future = future
+            self._warmup_grids = lookup_grids
+            threading.Thread(target=run, name="cameralib-warmup", daemon=True).start()
+            return future
+
+    def _warmup(self, lookup_grids=False):
+        start = time.time()
+        self._read_dem()
+        self._shot_arrays()
+
+        if lookup_grids and self.lookup_grid_spacing is not None:
+            # Grids that do not fit in memory are only worth building if they are saved
+            shots = self.shots
+            if self.lookup_grid_cache_dir is None:
+                shots = shots[:self._lookup_grids.maxsize]
+            for s in shots:
+                self._get_lookup_grid(s['filename'], s, self._shot_camera(s))
+
+        seconds = time.time() - start
+        logger.info(f"Loaded {self.project_path} in {seconds:.2f}s")
+        return seconds
+
+    def reload(self):
+        """Pick up changes to shots.geojson, cameras.json, the DEM and the mesh without rebuilding the projector.
+        Only the shots and cameras that changed are parsed again; the loaded DEM and the cached
+        results of images that did not change are kept.
+
+        Returns:
+            dict: what changed, with the following information
+            {
+                'shots': list       # Filenames of shots that were added, removed or modified
+
+                'cameras': list     # IDs of cameras that were added, removed or modified
+
+                'dem': bool         # Whether the DEM was released to be loaded again
+
+                'mesh': bool        # Whether the mesh was released to be loaded again
+            }
+        """
+        changed_shots = set()
+        changed_cameras = set()
+
+        if self._source_changed(self.shots_path):
+            changed_shots = self._load_shots()
+        if self._source_changed(self.cameras_path):
+            changed_cameras = self._load_cameras()
+
+        # Shots that use a changed camera are affected too
+        affected = set(changed_shots)
+        for s in self.shots:
+            if s['cam_id'] is not None and s['cam_id'].replace("v2 ", "") in changed_cameras:
+                affected.add(s['filename'])
+
+        if len(affected) > 0:
+            self._lookup_grids.discard(lambda k: k in affected)
+            if self.query_cache is not None:
+                self.query_cache.discard(lambda k: k[0] == 'world2cams' or (k[0] == 'cam2world' and k[1] in affected))
+
+        dem_changed = self.dem.changed()
+        if dem_changed:
+            # Cached results are discarded when the DEM is loaded again
+            self.dem.close()
+            if self._owns_dem:
+                self.dem = open_dem(self.dem_path, **self._dem_args)
+
+        mesh_changed = self.mesh is not None and self._source_changed(self.mesh_path)
+        if mesh_changed:
+            self.mesh = None
+            self.invalidate_cache()
+
+        return {
+            'shots': sorted(changed_shots),
+            'cameras': sorted(changed_cameras),
+            'dem': dem_changed,
+            'mesh': mesh_changed
+        }
+
+    def _source_changed(self, path):
+        st = os.stat(path)
+        prev = self._sources.get(path)
+        if prev is not None and prev[:2] == (st.st_mtime_ns, st.st_size):
+            return False
+
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+
+        self._sources[path] = (st.st_mtime_ns, st.st_size, digest)
+        return prev is None or prev[2] != digest
+
+    def _load_shots(self):
+        """Load shots, reusing the parsed shots whose properties did not change
+
+        Returns:
+            set: filenames of shots that were added, removed or modified
+        """
+        shots = []
+        shots_map = {}
+        shot_props = {}
+        changed = set()
+
+        for props in read_shots_properties(self.shots_path):
+            filename = props.get('filename') if props is not None else None
+            prev = self._shot_props.get(filename)
+            if prev is not None and prev[0] == props:
+                shot = prev[1]
+            else:
+                shot = parse_shot(props)
+                if shot is None:
+                    continue
+                changed.add(filename)
+
+            shot_props[filename] = (props, shot)
+            shots_map[filename] = len(shots)
+            shots.append(shot)
+
+        changed |= set(self._shot_props.keys()) - set(shot_props.keys())
+        self._shot_props = shot_props
+        self.shots, self.shots_map = shots, shots_map
+        self._shot_arrays_cache = None
+        return changed
+
+    def _load_cameras(self):
+        """Load cameras, reusing the parsed cameras whose definition did not change
+
+        Returns:
+            set: IDs of cameras that were added, removed or modified
+        """
+        cameras = {}
+        camera_props = {}
+        changed = set()
+
+        for cam_id, props in read_cameras(self.cameras_path).items():
+            prev = self._camera_props.get(cam_id)
+            if prev is not None and prev[0] == props:
+                cam = prev[1]
+            else:
+                cam = parse_camera(props)
+                if cam is None:
+                    continue
+                changed.add(cam_id)
+
+            camera_props[cam_id] = (props, cam)
+            cameras[cam_id] = cam
+
+        changed |= set(self._camera_props.keys()) - set(camera_props.keys())
+        self._camera_props = camera_props
+        self.cameras = cameras
+        return changed
+
+    def _read_mesh(self):
+        with self._mesh_lock:
+            if self.mesh is None:
+                self._source_changed(self.mesh_path)
+                vertices, faces = load_obj(self.mesh_path)
+
+                # ODM writes meshes relative to the georeferencing offset,
+                # pick the offset that places the mesh near the cameras
+                offset = read_odm_offset(self.project_path)
+                if offset is not None and len(self.shots) > 0:
+                    center = np.mean([s['translation'] for s in self.shots], axis=0)
+                    mesh_center = vertices.mean(axis=0)
+                    if np.linalg.norm((mesh_center + offset - center)[:2]) < np.linalg.norm((mesh_center - center)[:2]):
+                        vertices += offset
+
+                self.mesh = Mesh(vertices, faces)
+
+    def _check_cache_token(self):
+        # Results depend on the DEM and on the sampling settings
+        token = (id(self.dem), self.dem.mtime, self.mesh_path, self.z_sample_window, self.z_sample_strategy,
+                 self.raycast_resolution_multiplier, self.lookup_grid_spacing, self.lookup_grid_z_tolerance)
+        if token != self._cache_token:
+            if self._cache_token is not None:
+                self.invalidate_cache()
+            self._cache_token = token
+
+    def invalidate_cache(self):
+        """Discard memoized query results and lookup grids"""
+        self._lookup_grids.clear()
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+    def cache_info(self):
+        """Statistics of the query cache
+
+        Returns:
+            dict: hits, misses, size and maxsize of the cache, or None if the cache is disabled
+        """
+        if self.query_cache is not None:
+            return self.query_cache.info()
+
+    def _sample_z(self, xs, ys, arrays=None):
+        return self.dem.sample(xs, ys, window=self.z_sample_window, strategy=self.z_sample_strategy, arrays=arrays)
+
+    def close(self):
+        """Release the DEM held by this projector. It is loaded again on the next query."""
+        if self._owns_dem:
+            self.dem.close()
 
     def __del__(self):
-        if self.raster is not None:
-            self.raster.close()
-            self.raster = None
+        if getattr(self, 'dem', None) is not None:
+            self.close()
 
     def cam2world(self, image, coordinates, normalized=False):
         """Project 2D pixel coordinates in camera space to geographic coordinates
@@ -93,74 +402,324 @@ class Projector:
         Returns:
             list of tuples: longitude,latitude,elevation for each coordinate pair
         """
+        results, up = self._cam2world(image, coordinates, normalized)
+        return [r for r, u in zip(results, up) if not u]
+
+    def _cam2world(self, image, coordinates, normalized):
+        """Project pixel coordinates, keeping the results of all coordinate pairs aligned with the input
+
+        Returns:
+            tuple: results, up where results has a latitude,longitude,elevation tuple (or None) for each
+            coordinate pair and up is a boolean array that is True for rays pointing up (not cast)
+        """
+        s = self._get_shot(image)
+        cam = self._shot_camera(s)
+
+        self._read_dem()
+
+        if normalized:
+            coordinates = np.array(coordinates, dtype=np.float64) * np.array([s['width'], s['height']])
+        pixels = np.array(coordinates, dtype=np.float64).reshape((-1, 2))
+
+        rays_world = self._shot_rays(s, cam, pixels)
+        up = rays_world[:, 2] > 0
+        for _ in range(np.count_nonzero(up)):
+            logger.warning(f"Ray from {image} pointing up, cannot raycast")
+
+        results = [None] * len(pixels)
+        todo = np.flatnonzero(~up)
+        keys = None
+
+        if self.query_cache is not None:
+            keys = [('cam2world', image, x, y) for x, y in np.round(pixels / self.query_cache_precision).astype(np.int64).tolist()]
+            cached = {i: self.query_cache.get(keys[i], _MISS) for i in todo}
+            todo = np.array([i for i in todo if cached[i] is _MISS], dtype=np.int64)
+            for i, c in cached.items():
+                if c is not _MISS:
+                    results[i] = c
+
+        if len(todo) > 0:
+            points, hits = self._raycast_pixels(image, s, cam, pixels[todo], rays_world[todo])
+            lats, lons = get_latlon_many(self.dem.crs, points[hits, 0], points[hits, 1])
+            for i, lat, lon, z in zip(todo[hits], lats, lons, points[hits, 2]):
+                results[i] = (float(lat), float(lon), float(z))
+
+            if keys is not None:
+                for i in todo:
+                    self.query_cache.put(keys[i], results[i])
+
+        return results, up
+
+    def cam2world_array(self, image, coordinates, normalized=False):
+        """Project 2D pixel coordinates in camera space to geographic coordinates, returning a NumPy array.
+        Suited for large batches and for the writers in :mod:`cameralib.writers`.
+
+        Args:
+            image (str): image filename
+            coordinates (list of tuples or numpy.ndarray): x,y pixel coordinates
+            normalized (bool): whether the input coordinates are normalized to [0..1]
+
+        Returns:
+            numpy.ndarray: (N, 3) array of latitude, longitude, elevation in the same order as the input.
+            Rows are NaN for coordinates that cannot be projected.
+        """
+        s = self._get_shot(image)
+        cam = self._shot_camera(s)
+
+        self._read_dem()
+
+        pixels = np.array(coordinates, dtype=np.float64).reshape((-1, 2))
+        if len(pixels) == 0:
+            return np.empty((0, 3))
+        if normalized:
+            pixels = pixels * np.array([s['width'], s['height']])
+
+        rays_world = self._shot_rays(s, cam, pixels)
+        down = np.flatnonzero(rays_world[:, 2] <= 0)
+        results = np.full((len(pixels), 3), np.nan)
+
+        points, hits = self._raycast_pixels(image, s, cam, pixels[down], rays_world[down])
+        lats, lons = get_latlon_many(self.dem.crs, points[hits, 0], points[hits, 1])
+        results[down[hits]] = np.column_stack((lats, lons, points[hits, 2]))
+        return results
+
+    def _get_shot(self, image):
         if not image in self.shots_map:
             raise InvalidArgError(f"Image {image} not found in {self.shots_path}")
+        return self.shots[self.shots_map[image]]
 
-        s = self.shots[self.shots_map[image]]
-        cam_id = s['cam_id'].replace("v2 ", "")
-        cam = self.cameras[cam_id]
+    def _raycast_pixels(self, image, s, cam, pixels, rays_world):
+        if self.lookup_grid_spacing is not None:
+            return self._grid_raycast(image, s, cam, pixels, rays_world)
+        else:
+            return self._cast(s['translation'], rays_world)
+
+    def image2images(self, image, coordinates, normalized=False, include_source=False):
+        """Find where 2D pixel coordinates in one image fall in the other images of the reconstruction.
+        All coordinates are raycast in a single batch and reprojected into all candidate images at once.
+
+        Args:
+            image (str): image filename
+            coordinates (list of tuples): x,y pixel coordinates
+            normalized (bool): whether the input and output coordinates are normalized to [0..1]
+            include_source (bool): whether to include the source image in the results
+
+        Returns:
+            list of dict: A list of dictionaries, one for each image that sees at least one of the coordinates:
+            [
+                {
+                    'filename': str                 # The filename of the image
+
+                    'coordinates': numpy.ndarray    # (N, 2) array of x,y coordinates in the image, in the same order as the input
+
+                    'valid': numpy.ndarray          # (N, ) boolean array, False for coordinates that do not fall in the image
+                }
+            ]
+        """
+        s = self._get_shot(image)
+        cam = self._shot_camera(s)
 
         self._read_dem()
 
-        r = s['rotation']
-        focal = s['focal']
-        img_w = s['width']
-        img_h = s['height']
+        pixels = np.array(coordinates, dtype=np.float64).reshape((-1, 2))
         if normalized:
-            coordinates *= np.array([img_w, img_h])
+            pixels = pixels * np.array([s['width'], s['height']])
 
-        t = s['translation'].reshape(3, 1)
-        resolution_step = abs(self.raster.transform[0]) * self.raycast_resolution_multiplier
+        rays_world = self._shot_rays(s, cam, pixels)
+        down = rays_world[:, 2] <= 0
+        points = np.zeros((len(pixels), 3))
+        hits = np.zeros(len(pixels), dtype=bool)
+        points[down], hits[down] = self._raycast_pixels(image, s, cam, pixels[down], rays_world[down])
 
-        rays_cam = cam.pixel_bearing_many(np.array(coordinates)).T
-        rays_world = np.matmul(np.linalg.inv(r), rays_cam).T
-        results = []
+        if self.mesh is None:
+            # Elevation at the hit location, as world2cams would sample it
+            z = self._sample_z(points[hits, 0], points[hits, 1])
+            valid = z != self.dem_nodata
+            points[np.flatnonzero(hits)[valid], 2] = z[valid]
+            hits[np.flatnonzero(hits)[~valid]] = False
 
-        for ray_world in rays_world:
-            ray_world = ray_world.reshape((3, 1))
+        # Select candidate shots once for all points
+        x, y, inside = project_to_shots(self._shot_arrays(), points[hits])
+        results = []
+        for i in np.flatnonzero(inside.any(axis=1)):
+            target = self.shots[i]
+            if target['filename'] == image and not include_source:
+                continue
 
-            if float(ray_world[2]) > 0:
-                logger.warning(f"Ray from {image} pointing up, cannot raycast")
+            cam_id = target['cam_id'].replace("v2 ", "") if target['cam_id'] is not None else None
+            if cam_id is None or cam_id not in self.cameras:
                 continue
-        
-            step = 0 # meters
-            prev_pt = None
-            result = None
 
-            while True:
-                ray_pt = (ray_world * step + t).ravel()
-                step += resolution_step
+            coords = np.full((len(pixels), 2), np.nan)
+            valid = np.zeros(len(pixels), dtype=bool)
 
-                # No hits
-                if ray_pt[2] < self.min_z:
-                    break
-                
-                y, x = self.raster.index(ray_pt[0], ray_pt[1], op=round)
+            idx = np.flatnonzero(hits)[inside[i]]
+            xu, yu, v = distort_pixels(self.cameras[cam_id], x[i, inside[i]], y[i, inside[i]], target['width'], target['height'])
+            coords[idx, 0] = xu
+            coords[idx, 1] = yu
+            valid[idx] = v
+            if normalized:
+                coords /= np.array([target['width'], target['height']])
 
-                if x >= 0 and x < self.dem_data.shape[1] and y >= 0 and y < self.dem_data.shape[0]:
-                    pix_z = raster_sample_z(self.dem_data, self.raster.nodata, y, x, window=self.z_sample_window, strategy=self.z_sample_strategy)
+            if valid.any():
+                results.append({
+                    'filename': target['filename'],
+                    'coordinates': coords,
+                    'valid': valid
+                })
 
-                    if pix_z == self.raster.nodata:
-                        continue
+        return results
 
-                    if prev_pt is None:
-                        prev_pt = ray_pt
+    def _shot_arrays(self):
+        if self._shot_arrays_cache is None:
+            self._shot_arrays_cache = shots_to_arrays(self.shots)
+        return self._shot_arrays_cache
 
-                    if ray_pt[2] <= pix_z:
-                        # Hit
-                        midpoint = (prev_pt + ray_pt) / 2.0
-                        lat, lon = get_latlon(self.raster, midpoint[0], midpoint[1])
-                        result = (lat,lon,pix_z)
-                        break
+    def _shot_camera(self, s):
+        cam_id = s['cam_id'].replace("v2 ", "")
+        return self.cameras[cam_id]
 
-                    prev_pt = ray_pt
-            
-            results.append(result)
+    def _shot_rays(self, s, cam, pixels):
+        rays_cam = cam.pixel_bearing_many(pixels).T
+        return np.matmul(np.linalg.inv(s['rotation']), rays_cam).T
 
-        return results
-                        
+    def _cast(self, origin, rays_world):
+        if self.mesh is not None:
+            return self._mesh_raycast(origin, rays_world)
+        else:
+            return self._march(origin, rays_world)
+
+    def _mesh_raycast(self, origin, rays_world):
+        origin = np.asarray(origin, dtype=np.float64).ravel()
+        t = self.mesh.intersect(origin, rays_world)
+        hits = np.isfinite(t)
+        points = np.zeros((len(rays_world), 3))
+        points[hits] = rays_world[hits] * t[hits, None] + origin
+        return points, hits
+
+    def _march(self, origin, rays_world):
+        """March a batch of rays over the DEM
 
-    def cam2geoJSON(self, image, coordinates, properties={}, normalized=False):
+        Args:
+            origin (numpy.ndarray): ray origin (camera center)
+            rays_world (numpy.ndarray): (N, 3) array of unit ray directions pointing down
+
+        Returns:
+            tuple: points, hits where points is an (N, 3) array of easting, northing, elevation
+            and hits is a boolean array that is False for rays that did not hit the DEM
+        """
+        n = len(rays_world)
+        origin = np.asarray(origin, dtype=np.float64).ravel()
+        nodata = self.dem_nodata
+        resolution_step = self.dem.resolution * self.raycast_resolution_multiplier
+        arrays = self.dem.arrays()
+
+        points = np.zeros((n, 3))
+        hits = np.zeros(n, dtype=bool)
+        prev_pts = np.zeros((n, 3))
+        has_prev = np.zeros(n, dtype=bool)
+        active = np.arange(n)
+        step = 0 # meters
+
+        while len(active) > 0:
+            ray_pts = rays_world[active] * step + origin
+            step += resolution_step
+
+            # No hits
+            above = ray_pts[:, 2] >= self.min_z
+            active = active[above]
+            ray_pts = ray_pts[above]
+
+            pix_z = self._sample_z(ray_pts[:, 0], ray_pts[:, 1], arrays)
+            valid = pix_z != nodata
+            idx = active[valid]
+            ray_pts = ray_pts[valid]
+            pix_z = pix_z[valid]
+
+            first = ~has_prev[idx]
+            prev_pts[idx[first]] = ray_pts[first]
+            has_prev[idx] = True
+
+            hit = ray_pts[:, 2] <= pix_z
+            hit_idx = idx[hit]
+            points[hit_idx, :2] = ((prev_pts[hit_idx] + ray_pts[hit]) / 2.0)[:, :2]
+            points[hit_idx, 2] = pix_z[hit]
+            hits[hit_idx] = True
+
+            prev_pts[idx[~hit]] = ray_pts[~hit]
+            active = active[~hits[active]]
+
+        return points, hits
+
+    def _grid_raycast(self, image, s, cam, pixels, rays_world):
+        grid = self._get_lookup_grid(image, s, cam)
+        origin = s['translation'].ravel()
+
+        depth, ok = grid.interpolate(pixels, self.lookup_grid_z_tolerance)
+        points = rays_world * depth[:, None] + origin
+
+        if self.mesh is None:
+            self._grid_sample_z(points, ok)
+        hits = ok.copy()
+
+        # Exact raycast near discontinuities and at the edges of the grid
+        if not ok.all():
+            exact_points, exact_hits = self._cast(origin, rays_world[~ok])
+            points[~ok] = exact_points
+            hits[~ok] = exact_hits
+
+        return points, hits
+
+    def _grid_sample_z(self, points, ok):
+        z = self._sample_z(points[ok, 0], points[ok, 1])
+        valid = z != self.dem_nodata
+        points[np.flatnonzero(ok)[valid], 2] = z[valid]
+        ok[np.flatnonzero(ok)[~valid]] = False
+
+    def _get_lookup_grid(self, image, s, cam):
+        grid = self._lookup_grids.get(image)
+        if grid is not None:
+            return grid
+
+        grid_file = None
+        if self.lookup_grid_cache_dir is not None:
+            grid_file = os.path.join(self.lookup_grid_cache_dir, f"{image}-{self._lookup_grid_key(s, cam)}.npz")
+            if os.path.isfile(grid_file):
+                try:
+                    grid = LookupGrid.load(grid_file)
+                    self._lookup_grids.put(image, grid)
+                    return grid
+                except Exception as e:
+                    logger.warning(f"Cannot read lookup grid {grid_file}: {str(e)}")
+
+        xs, ys, nodes = LookupGrid.nodes(s['width'], s['height'], self.lookup_grid_spacing)
+        rays_world = self._shot_rays(s, cam, nodes)
+        origin = s['translation'].ravel()
+
+        depth = np.full(len(nodes), np.nan)
+        down = rays_world[:, 2] <= 0
+        points, hits = self._cast(origin, rays_world[down])
+        idx = np.flatnonzero(down)[hits]
+        depth[idx] = np.einsum('ij,ij->i', points[hits] - origin, rays_world[idx])
+
+        grid = LookupGrid(xs, ys, depth.reshape((len(ys), len(xs))))
+        if grid_file is not None:
+            os.makedirs(self.lookup_grid_cache_dir, exist_ok=True)
+            grid.save(grid_file)
+
+        self._lookup_grids.put(image, grid)
+        return grid
+
+    def _lookup_grid_key(self, s, cam):
+        h = hashlib.sha1()
+        h.update(repr((self.dem.key, self.dem.mtime, self.mesh_path,
+                       self.lookup_grid_spacing, self.z_sample_window, self.z_sample_strategy,
+                       self.z_fill_nodata, self.raycast_resolution_multiplier, self.dem.dtype, self.dem.z_scale,
+                       s['width'], s['height'], cam.focal, cam.cx, cam.cy, cam.distortion.tolist(),
+                       s['translation'].tolist(), s['rotation'].tolist())).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    def cam2geoJSON(self, image, coordinates, properties={}, normalized=False, densify=None, simplify=None):
         """Project 2D pixel coordinates in camera space to geographic coordinates and output the result
         as GeoJSON. A single coordinate results in a Point, two coordinates into a LineString and more than two into a Polygon.
         
@@ -168,49 +727,114 @@ class Projector:
             image (str): image filename
             coordinates (list of tuples): x,y pixel coordinates
             normalized (bool): whether the input coordinates are normalized to [0..1]
+            densify (float): If set, edges are subdivided in image space so that the projected points are about
+                this far apart on the ground (in DEM units), to let the edges follow the terrain.
+            simplify (float): If set, remove points that are closer than this distance (in DEM units) to the
+                simplified line (Douglas-Peucker)
         
         Returns:
             dict: GeoJSON
         """
-        results = self.cam2world(image, coordinates, normalized)
+        if densify is not None and densify <= 0:
+            raise InvalidArgError("densify must be > 0")
+        if simplify is not None and simplify < 0:
+            raise InvalidArgError("simplify must be >= 0")
+
+        vertices = None
+        if (densify is not None or simplify is not None) and len(coordinates) >= 2:
+            results = self._cam2world_densified(image, coordinates, normalized, densify, simplify)
+            # Densification adds points, keep the geometry type of the input
+            # (rays pointing up are dropped as in cam2world)
+            if len(results) >= len(coordinates):
+                vertices = len(coordinates)
+        else:
+            results = self.cam2world(image, coordinates, normalized)
 
         if 'image' not in properties:
             properties['image'] = image
-        
-        if len(results) == 1:
-            geom = 'Point'
-            lat,lon,z = results[0]
-            coords = [lon,lat,z]
-        elif len(results) == 2:
-            geom = 'LineString'
-            coords = list([lon,lat,z] for lat,lon,z in results)
-        else:
-            geom = 'Polygon'
-            coords = [list([lon,lat,z] for lat,lon,z in results)]
-            coords[0].append(coords[0][0])
 
         j = {
             'type': 'FeatureCollection',
             'features':[{
                 'type': 'Feature',
                 'properties': properties,
-                'geometry': {
-                    'coordinates': coords,
-                    'type': geom
-                }
+                'geometry': results_to_geometry(results, vertices)
             }]
         }
         
         return j
 
     
-    def world2cams(self, longitude, latitude, normalized=False):
+    def _cam2world_densified(self, image, coordinates, normalized, densify, simplify):
+        s = self._get_shot(image)
+        cam = self._shot_camera(s)
+
+        self._read_dem()
+
+        pixels = np.array(coordinates, dtype=np.float64).reshape((-1, 2))
+        if normalized:
+            pixels = pixels * np.array([s['width'], s['height']])
+
+        rays_world = self._shot_rays(s, cam, pixels)
+        if np.any(rays_world[:, 2] > 0):
+            return self.cam2world(image, pixels)
+
+        points, hits = self._raycast_pixels(image, s, cam, pixels, rays_world)
+        if not np.all(hits):
+            # Vertices that miss the surface are reported as in cam2world
+            return self.cam2world(image, pixels)
+
+        closed = len(pixels) > 2
+
+        # Ground spacing is not uniform along an edge in perspective images,
+        # so gaps that are still too long are subdivided again in a few passes
+        for _ in range(4 if densify is not None else 0):
+            if closed:
+                starts, ends = pixels, np.roll(pixels, -1, axis=0)
+                gaps = np.linalg.norm(np.roll(points, -1, axis=0) - points, axis=1)
+            else:
+                starts, ends = pixels[:-1], pixels[1:]
+                gaps = np.linalg.norm(points[1:] - points[:-1], axis=1)
+
+            segments = np.where(gaps > densify, np.ceil(gaps / densify), 1).astype(np.int64)
+            if np.all(segments == 1):
+                break
+
+            # Intermediate points of all edges, cast in a single batch
+            extra = segments - 1
+            edge = np.repeat(np.arange(len(starts)), extra)
+            step = np.arange(extra.sum()) - np.repeat(np.cumsum(extra) - extra, extra) + 1
+            mid_pixels = starts[edge] + (ends - starts)[edge] * (step / segments[edge])[:, None]
+
+            mid_rays = self._shot_rays(s, cam, mid_pixels)
+            down = np.flatnonzero(mid_rays[:, 2] <= 0)
+            mid_points = np.full((len(mid_pixels), 3), np.nan)
+            p, h = self._raycast_pixels(image, s, cam, mid_pixels[down], mid_rays[down])
+            mid_points[down[h]] = p[h]
+
+            # Points come first on their outgoing edge, intermediate points that missed are dropped
+            order = np.lexsort((np.concatenate((np.zeros(len(points)), step)),
+                                np.concatenate((np.arange(len(points)), edge))))
+            valid = ~np.isnan(np.concatenate((points, mid_points))[order][:, 0])
+            pixels = np.concatenate((pixels, mid_pixels))[order][valid]
+            points = np.concatenate((points, mid_points))[order][valid]
+
+        if simplify is not None:
+            points = points[simplify_line(points, simplify, closed)]
+
+        lats, lons = get_latlon_many(self.dem.crs, points[:, 0], points[:, 1])
+        return [(float(lat), float(lon), float(z)) for lat, lon, z in zip(lats, lons, points[:, 2])]
+
+    def world2cams(self, longitude, latitude, normalized=False, top_k=None):
         """Find which cameras in the reconstruction see a particular location.
 
         Args:
             longitude (float): Longitude
             latitude (float): Latitude
             normalized (bool): Whether to normalize pixel coordinates by the image dimension. By default pixel coordinates are in range [0..image width], [0..image height])
+            top_k (int): If set, return only the k best views of the location, ranked by score. The score is the product of
+                the cosine of the angle between the viewing direction and the surface normal (from the DEM), the ratio between
+                the distance of the closest camera and the distance of the camera, and the closeness of the location to the image centre.
 
         Returns:
             list of dict: A list of dictionaries where each dictionary represents a camera with the following information:
@@ -221,70 +845,419 @@ class Projector:
                     'x': float          # The x-coordinate in camera space
 
                     'y': float          # The y-coordinate in camera space 
+
+                    'score': float      # View quality score in [0..1] (only when top_k is set)
                 }
             ]
         """
+        if top_k is not None and top_k <= 0:
+            raise InvalidArgError("top_k must be > 0")
+
+        self._read_dem()
+
+        if self.query_cache is not None:
+            key = ('world2cams', round(longitude / self.query_cache_geo_precision), round(latitude / self.query_cache_geo_precision), normalized, top_k)
+            cached = self.query_cache.get(key)
+            if cached is None:
+                cached = self._world2cams(longitude, latitude, normalized, top_k)
+                self.query_cache.put(key, cached)
+            return [dict(c) for c in cached]
+
+        return self._world2cams(longitude, latitude, normalized, top_k)
+
+    def batch(self, requests, return_exceptions=False):
+        """Run a batch of cam2world and world2cams queries. Queries are reordered for locality:
+        the cam2world queries of each image are raycast together and world2cams queries are processed
+        in the order of a space filling curve over the DEM. Results are returned in the original order.
+
+        Args:
+            requests (list of dict): queries. Each query has an 'op' key that is either 'cam2world' or 'world2cams',
+                the other keys are the arguments of the corresponding method. For example:
+                [
+                    {'op': 'cam2world', 'image': 'DJI_0001.JPG', 'coordinates': [[100, 100]]},
+                    {'op': 'world2cams', 'longitude': 46.84, 'latitude': -91.99, 'top_k': 3}
+                ]
+            return_exceptions (bool): Whether to return the exception raised by a query as its result, instead of raising it
+
+        Returns:
+            list: the result of each query, as returned by :meth:`cam2world` or :meth:`world2cams`
+        """
+        results = [None] * len(requests)
+        cam2world = {}
+        coordinates = {}
+        world2cams = []
+
+        def fail(i, e):
+            if not return_exceptions:
+                raise e
+            results[i] = e
+
+        for i, r in enumerate(requests):
+            op = r.get('op') if isinstance(r, dict) else None
+            if op == 'cam2world':
+                missing = [k for k in ('image', 'coordinates') if k not in r]
+                if len(missing) > 0:
+                    fail(i, InvalidArgError(f"Missing {', '.join(missing)} in cam2world request"))
+                    continue
+                try:
+                    coordinates[i] = np.array(r['coordinates'], dtype=np.float64).reshape((-1, 2))
+                except (ValueError, TypeError):
+                    fail(i, InvalidArgError(f"Invalid coordinates in cam2world request: {r['coordinates']}"))
+                    continue
+                if len(coordinates[i]) == 0:
+                    # Nothing to raycast
+                    if r['image'] in self.shots_map:
+                        results[i] = []
+                    else:
+                        fail(i, InvalidArgError(f"Image {r['image']} not found in {self.shots_path}"))
+                    continue
+                cam2world.setdefault((r['image'], r.get('normalized', False)), []).append(i)
+            elif op == 'world2cams':
+                missing = [k for k in ('longitude', 'latitude') if k not in r]
+                top_k = r.get('top_k')
+                if len(missing) > 0:
+                    fail(i, InvalidArgError(f"Missing {', '.join(missing)} in world2cams request"))
+                elif not all(isinstance(r[k], (int, float, np.number)) and np.isfinite(r[k]) for k in ('longitude', 'latitude')):
+                    fail(i, InvalidArgError(f"Invalid coordinates in world2cams request: {r['longitude']}, {r['latitude']}"))
+                elif top_k is not None and top_k <= 0:
+                    fail(i, InvalidArgError("top_k must be > 0"))
+                else:
+                    world2cams.append(i)
+            else:
+                fail(i, InvalidArgError(f"Invalid op {op}"))
+
+        for (image, normalized), idx in cam2world.items():
+            try:
+                points, up = self._cam2world(image, np.concatenate([coordinates[i] for i in idx]), normalized)
+            except (InvalidArgError, CannotProjectError, GeoError) as e:
+                if not return_exceptions:
+                    raise
+                for i in idx:
+                    results[i] = e
+                continue
+
+            offsets = np.cumsum([0] + [len(coordinates[i]) for i in idx])
+            for k, i in enumerate(idx):
+                a, b = offsets[k], offsets[k + 1]
+                results[i] = [p for p, u in zip(points[a:b], up[a:b]) if not u]
+
+        if len(world2cams) > 0:
+            self._batch_world2cams(requests, world2cams, results, fail)
+
+        return results
+
+    def _batch_utm_xy(self, longitudes, latitudes, chunk_size=1024):
+        # Transform in chunks, and one location at a time in the chunks that fail,
+        # so that a location outside of the CRS domain fails only its own query
+        xs = np.full(len(longitudes), np.nan)
+        ys = np.full(len(longitudes), np.nan)
+        errors = {}
+        for c in range(0, len(longitudes), chunk_size):
+            chunk = slice(c, c + chunk_size)
+            try:
+                xs[chunk], ys[chunk] = get_utm_xy_many(self.dem.crs, longitudes[chunk], latitudes[chunk])
+                continue
+            except GeoError:
+                raise
+            except Exception:
+                pass
+
+            for j in range(c, min(c + chunk_size, len(longitudes))):
+                try:
+                    xs[j], ys[j] = get_utm_xy(self.dem.crs, longitudes[j], latitudes[j])
+                except GeoError:
+                    raise
+                except Exception as e:
+                    errors[j] = GeoError(f"Cannot transform {longitudes[j]}, {latitudes[j]} to {self.dem.crs}: {str(e)}")
+
+        for j in np.flatnonzero(~(np.isfinite(xs) & np.isfinite(ys))):
+            errors.setdefault(j, GeoError(f"Cannot transform {longitudes[j]}, {latitudes[j]} to {self.dem.crs}"))
+        return xs, ys, errors
+
+    def _batch_world2cams(self, requests, idx, results, fail, chunk_size=1024):
         self._read_dem()
-        Xa, Ya, Za = get_utm_xyz(self.raster, self.dem_data, self.dem_nodata, longitude, latitude, 
-                                    z_sample_window=self.z_sample_window,
-                                    z_sample_strategy=self.z_sample_strategy)
-        if Za == self.dem_nodata:
+
+        longitudes = np.array([requests[i]['longitude'] for i in idx], dtype=np.float64)
+        latitudes = np.array([requests[i]['latitude'] for i in idx], dtype=np.float64)
+        try:
+            xs, ys, errors = self._batch_utm_xy(longitudes, latitudes, chunk_size)
+        except GeoError as e:
+            for i in idx:
+                fail(i, e)
+            return
+
+        for j, e in errors.items():
+            fail(idx[j], e)
+        ok = np.ones(len(idx), dtype=bool)
+        ok[list(errors.keys())] = False
+
+        points = np.zeros((len(idx), 3))
+        valid = np.zeros(len(idx), dtype=bool)
+        if ok.any():
+            points[ok], valid[ok] = self._ground_points(xs[ok], ys[ok])
+
+        res = self.dem.resolution
+        keys_x = np.zeros(len(idx))
+        keys_y = np.zeros(len(idx))
+        if ok.any():
+            keys_x[ok] = (xs[ok] - np.nanmin(xs[ok])) / res
+            keys_y[ok] = (np.nanmax(ys[ok]) - ys[ok]) / res
+        order = np.argsort(morton_key(keys_x, keys_y), kind='stable')
+
+        todo = []
+        keys = {}
+        for j in order:
+            if not ok[j]:
+                continue
+            r = requests[idx[j]]
+            if self.query_cache is not None:
+                key = ('world2cams', round(r['longitude'] / self.query_cache_geo_precision), round(r['latitude'] / self.query_cache_geo_precision), r.get('normalized', False), r.get('top_k'))
+                cached = self.query_cache.get(key)
+                if cached is not None:
+                    results[idx[j]] = [dict(c) for c in cached]
+                    continue
+                keys[j] = key
+
+            if valid[j]:
+                todo.append(j)
+            else:
+                results[idx[j]] = []
+
+        # Neighbouring locations along the curve are projected together
+        for c in range(0, len(todo), chunk_size):
+            chunk = todo[c:c + chunk_size]
+            cams = self._points2cams(points[chunk],
+                                     [requests[idx[j]].get('normalized', False) for j in chunk],
+                                     [requests[idx[j]].get('top_k') for j in chunk])
+            for j, v in zip(chunk, cams):
+                results[idx[j]] = v
+
+        for j, key in keys.items():
+            self.query_cache.put(key, results[idx[j]])
+            results[idx[j]] = [dict(c) for c in results[idx[j]]]
+
+    def _world2cams(self, longitude, latitude, normalized, top_k=None):
+        point = self._ground_point(longitude, latitude)
+        if point is None:
             return []
-        
-        images = []
-        for s in self.shots:
-            r = s['rotation']
-            a1 = r[0][0]
-            b1 = r[0][1]
-            c1 = r[0][2]
-            a2 = r[1][0]
-            b2 = r[1][1]
-            c2 = r[1][2]
-            a3 = r[2][0]
-            b3 = r[2][1]
-            c3 = r[2][2]
-
-            cam_id = s['cam_id'].replace("v2 ", "")
-            focal = s['focal']
-            img_w = s['width']
-            img_h = s['height']
-            Xs, Ys, Zs = s['translation']
-
-            half_img_w = (img_w - 1) / 2.0
-            half_img_h = (img_h - 1) / 2.0
-            f = focal * max(img_w, img_h)
-
-            dx = (Xa - Xs)
-            dy = (Ya - Ys)
-            dz = (Za - Zs)
-
-            den = a3 * dx + b3 * dy + c3 * dz
-            x = half_img_w - (f * (a1 * dx + b1 * dy + c1 * dz) / den)
-            y = half_img_h - (f * (a2 * dx + b2 * dy + c2 * dz) / den)
-
-            if x >= 0 and y >= 0 and x <= img_w - 1 and y <= img_h - 1:
-                valid = True # assumed
+        return self._point2cams(point, normalized, top_k)
+
+    def _ground_point(self, longitude, latitude):
+        Xa, Ya = get_utm_xy(self.dem.crs, longitude, latitude)
+        points, valid = self._ground_points(np.array([Xa]), np.array([Ya]))
+        return points[0] if valid[0] else None
+
+    def _ground_points(self, xs, ys):
+        if self.mesh is not None:
+            # Top-most intersection of a vertical ray with the mesh
+            top = self.mesh.max_bound[2] + 1.0
+            origins = np.column_stack((xs, ys, np.full(len(xs), top)))
+            t = self.mesh.intersect(origins, np.tile([0.0, 0.0, -1.0], (len(xs), 1)))
+            valid = np.isfinite(t)
+            zs = top - t
+        else:
+            zs = self._sample_z(xs, ys).astype(np.float64)
+            valid = zs != self.dem_nodata
+
+        return np.column_stack((xs, ys, zs)), valid
+
+    def _point2cams(self, point, normalized, top_k):
+        return self._points2cams(point[None, :], [normalized], [top_k])[0]
+
+    def _points2cams(self, points, normalized, top_k):
+        """Find the cameras that see each point, projecting all points in a single batch
+
+        Args:
+            points (numpy.ndarray): (N, 3) array of points
+            normalized (list of bool): whether to normalize pixel coordinates, for each point
+            top_k (list of int): number of best views to return for each point, or None for all views
+
+        Returns:
+            list of list of dict: cameras for each point, see :meth:`world2cams`
+        """
+        arrays = self._shot_arrays()
+        x, y, inside = project_to_shots(arrays, points)
+
+        # Candidate (point, shot) pairs, sorted by point then by shot
+        point_idx, candidates = np.nonzero(inside.T)
+        x = x[candidates, point_idx]
+        y = y[candidates, point_idx]
+        img_w = arrays['width'][candidates]
+        img_h = arrays['height'][candidates]
+
+        # Back-undistort to find exact UV coordinates, one batch per camera model
+        xu = np.zeros(len(candidates))
+        yu = np.zeros(len(candidates))
+        has_xy = np.zeros(len(candidates), dtype=bool)
+        valid = np.ones(len(candidates), dtype=bool) # assumed for shots without a camera model
+        groups = {}
+        for j, i in enumerate(candidates):
+            cam_id = self.shots[i]['cam_id'].replace("v2 ", "")
+            if cam_id in self.cameras:
+                groups.setdefault(cam_id, []).append(j)
+
+        for cam_id, js in groups.items():
+            js = np.array(js)
+            xu[js], yu[js], valid[js] = distort_pixels(self.cameras[cam_id], x[js], y[js], img_w[js], img_h[js])
+            has_xy[js] = True
+
+        bounds = np.searchsorted(point_idx, np.arange(len(points) + 1))
+        results = []
+        for p in range(len(points)):
+            pairs = np.arange(bounds[p], bounds[p + 1])
+            order = pairs[valid[pairs]]
+            scores = None
+            if top_k[p] is not None and len(order) > 0:
+                px = np.where(has_xy, xu, img_w - 1 - np.round(x))[order]
+                py = np.where(has_xy, yu, img_h - 1 - np.round(y))[order]
+                scores = self._view_scores(points[p], candidates[order], px, py)
+
+                if top_k[p] < len(order):
+                    best = np.argpartition(-scores, top_k[p] - 1)[:top_k[p]]
+                else:
+                    best = np.arange(len(order))
+                best = best[np.argsort(-scores[best], kind='stable')]
+                order = order[best]
+                scores = scores[best]
+
+            images = []
+            for n, j in enumerate(order):
+                s = self.shots[candidates[j]]
                 result = {
                     'filename': s['filename']
                 }
-                if cam_id is not None and cam_id in self.cameras:
-                    cam = self.cameras[cam_id]
+                if has_xy[j]:
+                    result['x'] = float(xu[j])
+                    result['y'] = float(yu[j])
+                    if normalized[p]:
+                        result['x'] /= s['width']
+                        result['y'] /= s['height']
+                if scores is not None:
+                    result['score'] = float(scores[n])
+                images.append(result)
+            results.append(images)
+
+        return results
 
-                    # Back-undistort to find exact UV coordinates
+    def _view_scores(self, point, shot_idx, px, py):
+        arrays = self._shot_arrays()
+        view = arrays['translation'][shot_idx] - point
+        distance = np.linalg.norm(view, axis=1)
+        view /= distance[:, None]
 
-                    xi = img_w - 1 - int(round(x))
-                    yi = img_h - 1 - int(round(y))
-                    xu, yu = map_pixels(cam.undistorted(), cam, np.array([[xi, yi]])).ravel()
+        incidence = np.clip(view @ self._surface_normal(point), 0, 1)
+        proximity = distance.min() / distance
 
-                    valid = xu >= 0 and xu <= img_w and yu >= 0 and yu <= img_h
+        half_w = arrays['width'][shot_idx] / 2.0
+        half_h = arrays['height'][shot_idx] / 2.0
+        centrality = np.clip(1.0 - np.hypot(px - half_w, py - half_h) / np.hypot(half_w, half_h), 0, 1)
+
+        return incidence * proximity * centrality
+
+    def _surface_normal(self, point):
+        d = self.dem.resolution
+        x, y = point[0], point[1]
+        z = self._sample_z([x + d, x - d, x, x], [y, y, y + d, y - d])
+        if np.any(z == self.dem_nodata):
+            return np.array([0.0, 0.0, 1.0])
+
+        n = np.array([-(z[0] - z[1]) / (2 * d), -(z[2] - z[3]) / (2 * d), 1.0])
+        return n / np.linalg.norm(n)
+
+
+def results_to_geometry(results, vertices=None):
+    """Convert the output of :meth:`Projector.cam2world` to a GeoJSON geometry. A single coordinate
+    results in a Point, two coordinates into a LineString and more than two into a Polygon.
+
+    Args:
+        results (list of tuples): latitude,longitude,elevation for each point
+        vertices (int): Number of input coordinates the geometry type is chosen from, when the
+            results have more points than the input (for example after densification). Defaults to len(results).
+    """
+    if vertices is None:
+        vertices = len(results)
 
-                    result['x'] = float(xu)
-                    result['y'] = float(yu)
-                    if normalized:
-                        result['x'] /= img_w
-                        result['y'] /= img_h
-                
-                if valid:
-                    images.append(result)
+    if vertices == 1:
+        geom = 'Point'
+        lat,lon,z = results[0]
+        coords = [lon,lat,z]
+    elif vertices == 2:
+        geom = 'LineString'
+        coords = list([lon,lat,z] for lat,lon,z in results)
+    else:
+        geom = 'Polygon'
+        coords = [list([lon,lat,z] for lat,lon,z in results)]
+        coords[0].append(coords[0][0])
+
+    return {
+        'coordinates': coords,
+        'type': geom
+    }
+
+def simplify_line(points, tolerance, closed=False):
+    """Simplify a line with the Douglas-Peucker algorithm
+
+    Args:
+        points (numpy.ndarray): (N, D) array of coordinates
+        tolerance (float): maximum distance of the removed points from the simplified line
+        closed (bool): whether the points form a ring. Rings keep at least 3 points.
+
+    Returns:
+        numpy.ndarray: boolean mask of the points to keep
+    """
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    if n <= 2:
+        keep[:] = True
+        return keep
+
+    if closed:
+        # Split the ring at the point farthest from the first one
+        far = int(np.argmax(np.linalg.norm(points - points[0], axis=1)))
+        chains = [(0, far), (far, n)]
+        points = np.concatenate((points, points[:1]))
+    else:
+        chains = [(0, n - 1)]
+
+    keep = np.zeros(len(points), dtype=bool)
+    stack = list(chains)
+    while stack:
+        first, last = stack.pop()
+        keep[first] = keep[last] = True
+        if last - first < 2:
+            continue
+
+        a, b = points[first], points[last]
+        ab = b - a
+        ap = points[first + 1:last] - a
+        denom = ab @ ab
+        if denom > 0:
+            t = np.clip(ap @ ab / denom, 0, 1)
+        else:
+            t = np.zeros(len(ap))
+        dist = np.linalg.norm(ap - t[:, None] * ab, axis=1)
+
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            stack.append((first, first + 1 + i))
+            stack.append((first + 1 + i, last))
+
+    keep = keep[:n]
+    if closed and np.count_nonzero(keep) < 3:
+        keep[:] = True
+    return keep
+
+def morton_key(xs, ys, bits=21):
+    """Interleave the bits of non-negative coordinates to sort them along a Z-order curve
+
+    Returns:
+        numpy.ndarray: uint64 keys
+    """
+    def spread(v):
+        v = np.clip(np.nan_to_num(v), 0, (1 << bits) - 1).astype(np.uint64)
+        out = np.zeros(len(v), dtype=np.uint64)
+        for b in range(bits):
+            out |= ((v >> np.uint64(b)) & np.uint64(1)) << np.uint64(2 * b)
+        return out
 
-        return images
\ No newline at end of file
+    return spread(np.asarray(xs)) | (spread(np.asarray(ys)) << np.uint64(1))
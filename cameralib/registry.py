@@ -0,0 +1,172 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+from cameralib.projector import Projector
+from cameralib.exceptions import InvalidArgError
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProjectorPool:
+    """A pool of projectors for serving queries across multiple ODM projects.
+
+    Projectors are opened on demand by project path. Projects that sample the same DEM file
+    with the same settings share a single in-memory DEM. When the loaded DEMs exceed the memory
+    budget, DEM arrays are released in least recently used order (projects keep their parsed
+    shots and reload the DEM on their next query). When more than max_projects are open, the
+    least recently used projects are closed entirely.
+
+    Args:
+        max_memory (int): Memory budget in bytes for loaded DEMs. None for no limit.
+        max_projects (int): Maximum number of open projects. None for no limit.
+        **projector_args: Arguments passed to each :class:`Projector`
+    """
+    def __init__(self, max_memory=None, max_projects=None, **projector_args):
+        if max_memory is not None and max_memory <= 0:
+            raise InvalidArgError("max_memory must be > 0")
+        if max_projects is not None and max_projects <= 0:
+            raise InvalidArgError("max_projects must be > 0")
+
+        self.max_memory = max_memory
+        self.max_projects = max_projects
+        self.projector_args = projector_args
+
+        self._projectors = OrderedDict() # project path --> Projector
+        self._dems = OrderedDict() # DEM key --> DEM
+        self._dem_users = {} # DEM key --> set of project paths
+        self._lock = threading.RLock()
+
+    def get(self, project_path):
+        """Get the projector for a project, opening it if needed
+
+        Args:
+            project_path (str): Path to ODM project
+
+        Returns:
+            Projector: projector for the project
+        """
+        project_path = os.path.abspath(project_path)
+
+        with self._lock:
+            p = self._projectors.get(project_path)
+            if p is None:
+                p = self._open(project_path)
+            self._projectors.move_to_end(project_path)
+
+            key = self._dem_key(p.dem)
+            self._dems.move_to_end(key)
+
+            while self.max_projects is not None and len(self._projectors) > self.max_projects:
+                self._close_project(next(iter(self._projectors)))
+
+            self._trim(keep=key)
+            return p
+
+    def _open(self, project_path):
+        # Load only after the DEM has been shared
+        args = dict(self.projector_args)
+        preload = args.pop('preload', None)
+
+        p = Projector(project_path, **args)
+        key = self._dem_key(p.dem)
+
+        if key in self._dems:
+            # Share the DEM already held by another project
+            p.dem = self._dems[key]
+        else:
+            self._dems[key] = p.dem
+            self._dem_users[key] = set()
+            p.dem.on_load = self._dem_loaded
+
+        p._owns_dem = False
+        self._dem_users[key].add(project_path)
+        self._projectors[project_path] = p
+
+        if preload == 'eager':
+            p._warmup()
+        elif preload == 'background':
+            p.warmup()
+        return p
+
+    def _dem_key(self, dem):
+        return (dem.key, dem.fill_nodata, dem.dtype, dem.z_scale)
+
+    def _dem_loaded(self, dem):
+        # Released DEMs are loaded again by their next query, possibly through a projector
+        # that was evicted but is still held by a caller: keep them within the budget
+        with self._lock:
+            key = self._dem_key(dem)
+            if key not in self._dems:
+                self._dems[key] = dem
+                self._dem_users[key] = set()
+            if self._dems[key] is dem:
+                self._dems.move_to_end(key)
+                self._trim(keep=key)
+
+    def _trim(self, keep=None):
+        if self.max_memory is None:
+            return
+
+        reserved = self._dems[keep].estimated_nbytes if keep is not None and not self._dems[keep].loaded else 0
+        for key in list(self._dems.keys()):
+            if self.memory_usage() + reserved <= self.max_memory:
+                break
+
+            dem = self._dems[key]
+            if key != keep and dem.loaded:
+                logger.info(f"Releasing DEM {dem.path}")
+                dem.close()
+
+    def _close_project(self, project_path):
+        p = self._projectors.pop(project_path)
+        key = self._dem_key(p.dem)
+        self._dem_users[key].discard(project_path)
+
+        if len(self._dem_users[key]) == 0:
+            self._dems.pop(key).close()
+            del self._dem_users[key]
+
+    def evict(self, project_path):
+        """Close a project and release its DEM if no other project uses it
+
+        Args:
+            project_path (str): Path to ODM project
+        """
+        with self._lock:
+            project_path = os.path.abspath(project_path)
+            if project_path in self._projectors:
+                self._close_project(project_path)
+
+    def memory_usage(self):
+        """Bytes currently used by loaded DEMs"""
+        with self._lock:
+            return sum(dem.nbytes for dem in self._dems.values())
+
+    @property
+    def projects(self):
+        """Paths of the open projects, from least to most recently used"""
+        with self._lock:
+            return list(self._projectors.keys())
+
+    def close(self):
+        """Close all projects and their raster handles"""
+        with self._lock:
+            for project_path in list(self._projectors.keys()):
+                self._close_project(project_path)
+
+            # DEMs loaded again by evicted projectors
+            for dem in self._dems.values():
+                dem.close()
+            self._dems.clear()
+            self._dem_users.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
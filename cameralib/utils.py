@@ -32,21 +32,33 @@ def read_xanylabeling_annotations(labels_dir):
     annotations = []
 
     for fi in files:
-        with open(fi, 'r') as f:
-            j = json.load(f)
-    
-        annotations += [{
-                'image': os.path.basename(j['imagePath']),
-                'coordinates': s['points'],
-                'properties': {
-                    'label': s.get('label')
-                },
-                'normalized': False,
-            }for s in j['shapes']]
+        annotations += read_xanylabeling_annotation_file(fi)
     
     return annotations
 
 
+def read_xanylabeling_annotation_file(label_file):
+    """Read a single annotation file generated with X-AnyLabeling
+    
+    Args:
+        label_file (str): Path to a X-AnyLabeling JSON file
+    
+    Returns:
+        list of dict: annotations, see :func:`read_xanylabeling_annotations`
+    """
+    with open(label_file, 'r') as f:
+        j = json.load(f)
+
+    return [{
+            'image': os.path.basename(j['imagePath']),
+            'coordinates': s['points'],
+            'properties': {
+                'label': s.get('label')
+            },
+            'normalized': False,
+        }for s in j['shapes']]
+
+
 def read_yolov7_annotations(labels_dir, image_suffix='.JPG'):
     """Read an annotation directory in Yolov7 format
     
@@ -73,30 +85,46 @@ def read_yolov7_annotations(labels_dir, image_suffix='.JPG'):
     annotations = []
 
     for fi in files:
-        with open(fi, 'r') as f:
-            lines = [l for l in f.read().split("\n") if l.strip() != ""]  
-            for line in lines:
-                parts = line.split(" ")
-                if len(parts) == 5:
-                    try:
-                        label, x_center, y_center, width, height = [float(p) for p in parts]
-                        xmin = x_center - width / 2.0
-                        ymin = y_center - height / 2.0
-                        annotations.append({
-                            'image': Path(fi).with_suffix(image_suffix).name,
-                            'label': label,
-                            'bbox': {
-                                'xmin': xmin,
-                                'xmax': xmin + width,
-                                'ymin': ymin,
-                                'ymax': ymin + height
-                            }
-                        })
-                    except ValueError as e:
-                        logger.warning(f"Cannot parse values in {line} ({fi})")
-                else:
-                    logger.warning(f"Cannot parse line {line} ({fi})")
+        annotations += read_yolov7_annotation_file(fi, image_suffix)
         
+    return annotations
+
+
+def read_yolov7_annotation_file(label_file, image_suffix='.JPG'):
+    """Read a single label file in Yolov7 format
+    
+    Args:
+        label_file (str): Path to a Yolov7 label file
+        image_suffix (str): Extension of the target image
+    
+    Returns:
+        list of dict: annotations, see :func:`read_yolov7_annotations`
+    """
+    annotations = []
+    with open(label_file, 'r') as f:
+        lines = [l for l in f.read().split("\n") if l.strip() != ""]  
+        for line in lines:
+            parts = line.split(" ")
+            if len(parts) == 5:
+                try:
+                    label, x_center, y_center, width, height = [float(p) for p in parts]
+                    xmin = x_center - width / 2.0
+                    ymin = y_center - height / 2.0
+                    annotations.append({
+                        'image': Path(label_file).with_suffix(image_suffix).name,
+                        'label': label,
+                        'bbox': {
+                            'xmin': xmin,
+                            'xmax': xmin + width,
+                            'ymin': ymin,
+                            'ymax': ymin + height
+                        }
+                    })
+                except ValueError as e:
+                    logger.warning(f"Cannot parse values in {line} ({label_file})")
+            else:
+                logger.warning(f"Cannot parse line {line} ({label_file})")
+
     return [{
             'image': a['image'],
             'coordinates': [
@@ -0,0 +1,283 @@
+import os
+import json
+import math
+import numpy as np
+from cameralib.exceptions import InvalidArgError
+
+
+DRIVERS = {
+    '.ndjson': 'NDJSON',
+    '.geojsonl': 'NDJSON',
+    '.geojsons': 'NDJSON',
+    '.jsonl': 'NDJSON',
+    '.fgb': 'FlatGeobuf',
+    '.gpkg': 'GPKG',
+    '.parquet': 'Parquet',
+    '.arrow': 'Arrow',
+    '.feather': 'Arrow',
+}
+
+def open_writer(path, driver=None, chunk_size=10000):
+    """Open a writer for streaming projected points to a file
+
+    Args:
+        path (str): output file
+        driver (str): One of: ['NDJSON', 'FlatGeobuf', 'GPKG', 'Parquet', 'Arrow']. By default it's chosen from the file extension.
+            FlatGeobuf and GPKG require fiona, Parquet and Arrow require pyarrow.
+        chunk_size (int): number of points buffered before they are written
+
+    Returns:
+        PointWriter: a writer
+    """
+    if driver is None:
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in DRIVERS:
+            raise InvalidArgError(f"Cannot guess the output format of {path}, please specify a driver")
+        driver = DRIVERS[ext]
+
+    if driver == 'NDJSON':
+        return NDJSONWriter(path, chunk_size)
+    elif driver in ['FlatGeobuf', 'GPKG']:
+        return OGRWriter(path, driver, chunk_size)
+    elif driver in ['Parquet', 'Arrow']:
+        return ArrowWriter(path, driver, chunk_size)
+    else:
+        raise InvalidArgError(f"Invalid driver {driver}")
+
+
+class PointWriter:
+    """Base class for writers of projected points. Points are buffered in chunks and written
+    as columns, so memory usage does not depend on the number of points written.
+
+    Args:
+        path (str): output file
+        chunk_size (int): number of points buffered before they are written
+    """
+    def __init__(self, path, chunk_size=10000):
+        if chunk_size <= 0:
+            raise InvalidArgError("chunk_size must be > 0")
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self.count = 0
+        self._columns = None
+        self._chunks = []
+        self._buffered = 0
+
+    def write(self, latitudes, longitudes, elevations, properties=None):
+        """Write points
+
+        Args:
+            latitudes (numpy.ndarray): latitudes (NaN for points that could not be projected)
+            longitudes (numpy.ndarray): longitudes
+            elevations (numpy.ndarray): elevations
+            properties (dict): property name --> array of values, or a single value for all points.
+                All calls must use the same property names.
+        """
+        n = len(latitudes)
+        if n == 0:
+            return
+
+        chunk = {
+            'latitude': np.asarray(latitudes, dtype=np.float64),
+            'longitude': np.asarray(longitudes, dtype=np.float64),
+            'elevation': np.asarray(elevations, dtype=np.float64),
+        }
+        for k, v in (properties or {}).items():
+            if np.ndim(v) == 0:
+                v = np.full(n, v, dtype=object if isinstance(v, str) else None)
+            chunk[k] = np.asarray(v)
+
+        if self._columns is None:
+            self._columns = list(chunk.keys())
+        elif list(chunk.keys()) != self._columns:
+            raise InvalidArgError(f"Properties must be the same for all writes: {self._columns[3:]}")
+
+        self._chunks.append(chunk)
+        self._buffered += n
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def write_array(self, results, properties=None):
+        """Write the output of :meth:`Projector.cam2world_array`
+
+        Args:
+            results (numpy.ndarray): (N, 3) array of latitude, longitude, elevation
+            properties (dict): see :meth:`write`
+        """
+        self.write(results[:, 0], results[:, 1], results[:, 2], properties)
+
+    def flush(self):
+        if self._buffered == 0:
+            return
+
+        chunk = {k: np.concatenate([c[k] for c in self._chunks]) for k in self._columns}
+        self._write_chunk(chunk, self._buffered)
+        self.count += self._buffered
+        self._chunks = []
+        self._buffered = 0
+
+    def _write_chunk(self, chunk, n):
+        raise NotImplementedError()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class NDJSONWriter(PointWriter):
+    """Write points as newline delimited GeoJSON features"""
+    def __init__(self, path, chunk_size=10000):
+        super().__init__(path, chunk_size)
+        self._f = open(path, 'w', encoding='utf-8')
+
+    def _write_chunk(self, chunk, n):
+        lats = chunk['latitude'].tolist()
+        lons = chunk['longitude'].tolist()
+        zs = chunk['elevation'].tolist()
+
+        # Encode property values once per column instead of once per feature
+        props = []
+        for k in self._columns[3:]:
+            values = chunk[k].tolist()
+            props.append((json.dumps(k), _json_values(values)))
+
+        lines = []
+        for i in range(n):
+            if math.isnan(lats[i]):
+                geom = 'null'
+            else:
+                geom = f'{{"type": "Point", "coordinates": [{lons[i]!r}, {lats[i]!r}, {zs[i]!r}]}}'
+            p = ", ".join(f'{k}: {v[i]}' for k, v in props)
+            lines.append(f'{{"type": "Feature", "geometry": {geom}, "properties": {{{p}}}}}\n')
+
+        self._f.write("".join(lines))
+
+    def close(self):
+        super().close()
+        self._f.close()
+
+def _json_values(values):
+    encoded = {}
+    result = []
+    for v in values:
+        if isinstance(v, float) and math.isnan(v):
+            result.append('null')
+            continue
+        key = (type(v), v)
+        if key not in encoded:
+            encoded[key] = json.dumps(v)
+        result.append(encoded[key])
+    return result
+
+
+class OGRWriter(PointWriter):
+    """Write points to an OGR vector format (FlatGeobuf, GeoPackage) using fiona"""
+    def __init__(self, path, driver, chunk_size=10000):
+        try:
+            import fiona
+        except ImportError:
+            raise ImportError(f"fiona is required to write {driver} files (pip install fiona)")
+
+        super().__init__(path, chunk_size)
+        self.driver = driver
+        self._fiona = fiona
+        self._dst = None
+        self._closed = False
+
+    def _open(self, properties, empty=False):
+        schema = {
+            'geometry': '3D Point',
+            'properties': properties
+        }
+        options = {}
+        if self.driver == 'FlatGeobuf' and not empty:
+            # The packed spatial index does not allow null geometries
+            # and requires all features to be kept until the file is closed
+            options['SPATIAL_INDEX'] = 'NO'
+        self._dst = self._fiona.open(self.path, 'w', driver=self.driver, crs='EPSG:4326', schema=schema, **options)
+
+    def _write_chunk(self, chunk, n):
+        keys = self._columns[3:]
+        if self._dst is None:
+            self._open({k: _ogr_type(chunk[k]) for k in keys})
+
+        lats = chunk['latitude'].tolist()
+        lons = chunk['longitude'].tolist()
+        zs = chunk['elevation'].tolist()
+        columns = [chunk[k].tolist() for k in keys]
+
+        records = []
+        for i in range(n):
+            geom = None if math.isnan(lats[i]) else {'type': 'Point', 'coordinates': (lons[i], lats[i], zs[i])}
+            records.append({
+                'geometry': geom,
+                'properties': {k: c[i] for k, c in zip(keys, columns)}
+            })
+        self._dst.writerecords(records)
+
+    def close(self):
+        if self._closed:
+            return
+        super().close()
+        if self._dst is None:
+            # Nothing was written, create an empty layer. FlatGeobuf only writes
+            # the header of an empty file when it has a spatial index
+            self._open({}, empty=True)
+        self._dst.close()
+        self._closed = True
+
+def _ogr_type(values):
+    if np.issubdtype(values.dtype, np.bool_):
+        return 'bool'
+    if np.issubdtype(values.dtype, np.integer):
+        return 'int'
+    if np.issubdtype(values.dtype, np.floating):
+        return 'float'
+    return 'str'
+
+
+class ArrowWriter(PointWriter):
+    """Write points as columns to Parquet or Arrow IPC files using pyarrow"""
+    def __init__(self, path, driver, chunk_size=10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(f"pyarrow is required to write {driver} files (pip install pyarrow)")
+
+        super().__init__(path, chunk_size)
+        self.driver = driver
+        self._pa = pyarrow
+        self._dst = None
+        self._closed = False
+
+    def _open(self, schema):
+        if self.driver == 'Parquet':
+            self._dst = self._pa.parquet.ParquetWriter(self.path, schema)
+        else:
+            self._dst = self._pa.ipc.new_file(self.path, schema)
+
+    def _write_chunk(self, chunk, n):
+        pa = self._pa
+        table = pa.table({k: chunk[k] if chunk[k].dtype != object else chunk[k].tolist() for k in self._columns})
+
+        if self._dst is None:
+            self._open(table.schema)
+        self._dst.write_table(table)
+
+    def close(self):
+        if self._closed:
+            return
+        super().close()
+        if self._dst is None:
+            # Nothing was written, create an empty table
+            pa = self._pa
+            self._open(pa.schema([(k, pa.float64()) for k in ('latitude', 'longitude', 'elevation')]))
+        self._dst.close()
+        self._closed = True
@@ -0,0 +1,23 @@
+import os, glob
+from cameralib.jobs import ProjectionJob
+from cameralib.tests import get_test_dataset
+
+dataset = get_test_dataset()
+job_dir = os.path.join(dataset, "job")
+
+# Create the job once, then run it again after a crash to resume it.
+# Other processes or machines sharing job_dir can run it at the same time.
+if os.path.isfile(os.path.join(job_dir, "job.json")):
+    job = ProjectionJob(job_dir)
+else:
+    labels = glob.glob(os.path.join(dataset, "images", "*.json"))
+    job = ProjectionJob.create(job_dir, dataset, labels, format='xanylabeling', shard_size=10)
+
+for s in job.run(workers=2):
+    print(f"Shard {s['shard']}: {s['annotations']} annotations, {s['throughput']:.1f}/s")
+
+print(job.status())
+
+out = os.path.join(dataset, "labels.geojson")
+job.merge(out)
+print(out)
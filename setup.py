@@ -23,5 +23,9 @@ setuptools.setup(
         "License :: OSI Approved :: AGPL-3.0-or-later License",
         "Operating System :: OS Independent",
     ],
-    install_requires=required
+    install_requires=required,
+    extras_require={
+        'ogr': ['fiona'],
+        'arrow': ['pyarrow'],
+    }
 )
\ No newline at end of file